@@ -0,0 +1,103 @@
+'''
+File download benchmark
+
+MB/s downloading a big file from /files/{file_path:path}:
+
+    * naive: Response(open(path, "rb").read()), the whole file in memory.
+    * chunks: SendfileResponse, without help from the server, os.pread()
+      in chunks.
+
+The "http.response.zerocopysend" path of SendfileResponse is not measured:
+its cost is in the server and the kernel sending the file to a real
+socket, there's nothing to measure without them.
+
+The app is called directly with ASGI messages, no server or HTTP client,
+so the numbers only include the app and the copies it makes. The file is
+in the page cache after the first download, it measures copies, not the
+disk.
+
+Run it with:
+
+$ python bench_file_response.py [megabytes] [downloads]
+'''
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from fastapi import FastAPI, Response
+
+import main
+
+SCOPE = {
+    "type": "http",
+    "asgi": {"version": "3.0"},
+    "http_version": "1.1",
+    "method": "GET",
+    "scheme": "http",
+    "path": "/files/big.bin",
+    "raw_path": b"/files/big.bin",
+    "root_path": "",
+    "query_string": b"",
+    "headers": [(b"host", b"test")],
+    "client": ("127.0.0.1", 12345),
+    "server": ("test", 80),
+}
+
+
+def naive_app(files_dir: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/files/{file_path:path}")
+    async def read_file(file_path: str):
+        with open(os.path.join(files_dir, file_path), "rb") as f:
+            return Response(f.read(), media_type="application/octet-stream")
+
+    return app
+
+
+async def download(app) -> int:
+    received = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal received
+        if message["type"] == "http.response.body":
+            received += len(message.get("body", b""))
+
+    await app(dict(SCOPE), receive, send)
+    return received
+
+
+async def run_downloads(app, count: int, size: int):
+    # Warm up, and the file gets in the page cache
+    assert await download(app) == size
+    start = time.perf_counter()
+    for _ in range(count):
+        await download(app)
+    return time.perf_counter() - start
+
+
+def main_bench():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    size = megabytes * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as files_dir:
+        with open(os.path.join(files_dir, "big.bin"), "wb") as f:
+            for _ in range(megabytes):
+                f.write(os.urandom(1024 * 1024))
+        main.FILES_DIR = files_dir
+
+        print(f"{count} downloads of {megabytes} MB")
+        for label, app in (("naive", naive_app(files_dir)),
+                           ("chunks", main.app)):
+            elapsed = asyncio.run(run_downloads(app, count, size))
+            print(f"{label:>9}: {megabytes * count / elapsed:8.0f} MB/s")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,188 @@
+'''
+Serving files
+
+SendfileResponse sends a file from the disk:
+
+    * Without copying it through Python when the server can do it: with
+      the ASGI "http.response.zerocopysend" extension the server gets the
+      open file and sends it with os.sendfile(), from the kernel page
+      cache to the socket. With "http.response.pathsend" it gets the path.
+      Otherwise the file is read in big chunks (FILE_CHUNK_SIZE) with
+      os.pread() in a thread, and never all at once in memory.
+    * With "Range: bytes=start-end" only that part is sent (206), so
+      downloads can be resumed and videos seeked. "If-Range" makes the
+      range apply only if the file didn't change since.
+    * With an ETag (from the inode, modification time and size of the
+      file) and "If-None-Match", a client that already has the file gets
+      a 304 without the content.
+
+resolve_path() turns the path of the URL into a path inside the files
+directory, and refuses the ones that would go outside of it ("../..",
+absolute paths, symbolic links pointing out).
+'''
+import os
+from email.utils import formatdate
+from mimetypes import guess_type
+from typing import Optional, Tuple
+
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def resolve_path(root: str, file_path: str) -> Optional[str]:
+    '''
+    The real path of file_path inside root, or None if it's outside.
+    '''
+    if "\0" in file_path:
+        return None
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, file_path.lstrip("/")))
+    if os.path.commonpath((root, path)) != root:
+        return None
+    return path
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    '''
+    (start, end) of a "bytes=start-end" header, end included. None if the
+    header is not one valid range, and (size, size) if the range is after
+    the end of the file.
+    '''
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        # Several ranges at once are rare, the whole file is sent instead
+        return None
+    first, dash, last = spec.strip().partition("-")
+    first, last = first.strip(), last.strip()
+    # Each side empty or only 0-9, and not both empty. An invalid Range is
+    # ignored, the whole file is sent.
+    if not dash or not (first or last) or \
+            not all(side.isascii() and side.isdigit()
+                    for side in (first, last) if side):
+        return None
+    if not first:
+        # "-500": the last 500 bytes
+        length = int(last)
+        if length == 0:
+            return size, size
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        return size, size
+    return start, min(end, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, "W/" doesn't matter
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+class SendfileResponse(Response):
+    chunk_size = FILE_CHUNK_SIZE
+
+    def __init__(self, path: str, stat_result: os.stat_result,
+                 media_type: Optional[str] = None,
+                 background: Optional[BackgroundTask] = None):
+        self.path = path
+        self.size = stat_result.st_size
+        self.etag = '"{:x}-{:x}-{:x}"'.format(
+            stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        # The content is sent from the file, not from self.body. The
+        # Content-Length of the whole file, replaced for a range or a 304.
+        super().__init__(
+            headers={
+                "accept-ranges": "bytes",
+                "etag": self.etag,
+                "last-modified": self.last_modified,
+                "content-length": str(self.size),
+            },
+            media_type=media_type or guess_type(path)[0] or
+            "application/octet-stream",
+            background=background,
+        )
+
+    def _choose(self, request_headers: Headers) -> Tuple[int, int, int]:
+        '''
+        The status code, and the first and last + 1 byte to send.
+        '''
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None and \
+                _etag_matches(if_none_match, self.etag):
+            return 304, 0, 0
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        # If-Range needs the exact (strong) ETag or date, else the file
+        # could have changed and the whole file is sent
+        if range_header is None or (if_range is not None and if_range
+                                    not in (self.etag, self.last_modified)):
+            return 200, 0, self.size
+        byte_range = parse_range(range_header, self.size)
+        if byte_range is None:
+            return 200, 0, self.size
+        start, end = byte_range
+        if start >= self.size:
+            return 416, 0, 0
+        return 206, start, end + 1
+
+    async def __call__(self, scope, receive, send):
+        status_code, start, end = self._choose(Headers(scope=scope))
+        headers = [(name, value) for name, value in self.raw_headers
+                   if name != b"content-length"]
+        if status_code == 206:
+            headers.append((b"content-range",
+                            f"bytes {start}-{end - 1}/{self.size}".encode()))
+        elif status_code == 416:
+            headers.append((b"content-range", f"bytes */{self.size}".encode()))
+        if status_code != 304:
+            headers.append((b"content-length", str(end - start).encode()))
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": headers})
+        extensions = scope.get("extensions") or {}
+        if scope["method"] == "HEAD" or end == start:
+            await send({"type": "http.response.body", "body": b""})
+        elif "http.response.zerocopysend" in extensions:
+            file = await run_in_threadpool(open, self.path, "rb")
+            try:
+                await send({"type": "http.response.zerocopysend",
+                            "file": file, "offset": start,
+                            "count": end - start})
+            finally:
+                await run_in_threadpool(file.close)
+        elif "http.response.pathsend" in extensions and status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.path})
+        else:
+            await self._send_chunks(send, start, end)
+        if self.background is not None:
+            await self.background()
+
+    async def _send_chunks(self, send, start: int, end: int):
+        fd = await run_in_threadpool(os.open, self.path, os.O_RDONLY)
+        try:
+            offset = start
+            while offset < end:
+                chunk = await run_in_threadpool(
+                    os.pread, fd, min(self.chunk_size, end - offset), offset)
+                if not chunk:
+                    # The file got shorter while it was being sent
+                    break
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk,
+                            "more_body": offset < end})
+            if offset < end:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            await run_in_threadpool(os.close, fd)
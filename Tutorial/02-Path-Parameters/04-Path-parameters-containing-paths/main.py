@@ -31,15 +31,35 @@ In this case, the name of the parameter is file_path, and the last part,
 :path, tells it that the parameter should match any path.
 
 '''
+import os
+import stat
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from file_response import SendfileResponse, resolve_path
+
+# The files that can be downloaded, e.g. /files/home/johndoe/myfile.txt
+# is FILES_DIR/home/johndoe/myfile.txt
+FILES_DIR = "files"
 
 app = FastAPI()
 
 
-@app.get("/files/{file_path:path}")
+# A GET path operation also answers HEAD requests
+@app.api_route("/files/{file_path:path}", methods=["GET", "HEAD"])
 async def read_file(file_path: str):
-    return {"file_path": file_path}
+    # Never use file_path directly, it could be "../../etc/passwd"
+    path = resolve_path(FILES_DIR, file_path)
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    return SendfileResponse(path, stat_result)
 
 
 # You could need the parameter to contain
@@ -48,3 +68,6 @@ async def read_file(file_path: str):
 # In that case, the URL would be:
 # /files//home/johndoe/myfile.txt, with a double slash (//)
 # between files and home.
+
+# Here the file would still be inside FILES_DIR, a leading slash is
+# ignored.
@@ -0,0 +1,73 @@
+'''
+Fast parsing of small forms
+
+A login form (username=johndoe&password=secret) is a few dozen bytes, but
+await request.form() handles it like any form: a streaming parser from
+python-multipart, with a callback for each piece of each field, made to
+receive big forms in chunks.
+
+FastFormRoute reads small application/x-www-form-urlencoded bodies (with a
+Content-Length of up to SMALL_FORM_MAX_SIZE) at once and splits them with
+urllib.parse.parse_qsl(), in C for the most part. The result is the same
+FormData, the path operation and the validation of the fields don't change.
+Bigger forms, forms without Content-Length and multipart/form-data (with
+files) go to the normal parser.
+
+Set it with app.router.route_class = FastFormRoute before declaring the
+path operations.
+
+17-Form-Data/01-Form and the lessons 04 and 05 of 25-Security each have a
+copy of this file, so every lesson runs on its own. Keep them the same.
+'''
+from urllib.parse import parse_qsl
+
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.datastructures import FormData
+from starlette.requests import Request
+
+SMALL_FORM_MAX_SIZE = 16 * 1024
+SMALL_FORM_MAX_FIELDS = 100
+
+
+def parse_small_form(body: bytes) -> FormData:
+    '''
+    The fields of an urlencoded body, decoded the same way as Starlette
+    does: "+" is a space and %XX are UTF-8 bytes.
+    '''
+    try:
+        fields = parse_qsl(body.decode("latin-1"), keep_blank_values=True,
+                           max_num_fields=SMALL_FORM_MAX_FIELDS)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many fields, the maximum is {SMALL_FORM_MAX_FIELDS}")
+    return FormData(fields)
+
+
+def is_small_urlencoded(request: Request) -> bool:
+    content_type = request.headers.get("content-type", "")
+    if content_type.partition(";")[0].strip().lower() != \
+            "application/x-www-form-urlencoded":
+        return False
+    content_length = request.headers.get("content-length", "")
+    return content_length.isdigit() and \
+        int(content_length) <= SMALL_FORM_MAX_SIZE
+
+
+class FastFormRequest(Request):
+    async def _get_form(self, **kwargs):
+        if self._form is None and is_small_urlencoded(self):
+            self._form = parse_small_form(await self.body())
+        return await super()._get_form(**kwargs)
+
+
+class FastFormRoute(APIRoute):
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def fast_form_route_handler(request: Request):
+            request = FastFormRequest(request.scope, request.receive)
+            return await original_route_handler(request)
+
+        return fast_form_route_handler
@@ -10,7 +10,11 @@ E.g. pip install python-multipart.
 
 from fastapi import FastAPI, Form
 
+from fast_form import FastFormRoute
+
 app = FastAPI()
+# Small urlencoded forms skip the streaming parser (see fast_form.py)
+app.router.route_class = FastFormRoute
 
 
 # Create form parameters the same way you would for Body or Query
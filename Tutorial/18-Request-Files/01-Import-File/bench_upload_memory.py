@@ -0,0 +1,125 @@
+'''
+Upload memory benchmark
+
+Uploads one big file to each of the three path operations:
+
+    * /files/ (file: bytes)
+    * /uploadfile/ (file: UploadFile)
+    * /streamfiles/ (streaming.py)
+
+and shows how much the peak memory (RSS) of the process grew, and the
+time it took. Each one runs in a new process, as the peak memory of a
+process never goes down.
+
+The app is called directly with ASGI messages, no server or HTTP client,
+and the request body is generated while it is sent, so it doesn't use
+memory either. The files are written to a blob store in a temporary
+directory that is removed at the end.
+
+Run it with:
+
+$ python bench_upload_memory.py [megabytes]
+'''
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BOUNDARY = b"----bench-upload-memory-boundary"
+CHUNK_SIZE = 64 * 1024
+PATHS = ("/files/", "/uploadfile/", "/streamfiles/")
+
+
+def make_scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"test"),
+            (b"content-type",
+             b"multipart/form-data; boundary=" + BOUNDARY),
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("test", 80),
+    }
+
+
+def body_chunks(size: int):
+    yield (b"--" + BOUNDARY + b"\r\n"
+           b'Content-Disposition: form-data; name="file"; '
+           b'filename="big.bin"\r\n'
+           b"Content-Type: application/octet-stream\r\n\r\n")
+    chunk = os.urandom(CHUNK_SIZE)
+    for _ in range(size // CHUNK_SIZE):
+        yield chunk
+    yield b"\r\n--" + BOUNDARY + b"--\r\n"
+
+
+async def upload(app, path: str, size: int) -> int:
+    chunks = body_chunks(size)
+    status = None
+
+    async def receive():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return {"type": "http.request", "body": b"", "more_body": False}
+        return {"type": "http.request", "body": chunk, "more_body": True}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(make_scope(path), receive, send)
+    return status
+
+
+def peak_rss_mb() -> float:
+    # In KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_upload(path: str, size: int, results):
+    with tempfile.TemporaryDirectory() as directory:
+        # Before importing the app, it creates its blob store here
+        os.chdir(directory)
+        from main import app
+
+        # Warm up with a small file, imports and first request setup
+        asyncio.run(upload(app, path, CHUNK_SIZE))
+        before = peak_rss_mb()
+        start = time.perf_counter()
+        status = asyncio.run(upload(app, path, size))
+        elapsed = time.perf_counter() - start
+        results.put((status, peak_rss_mb() - before, elapsed))
+
+
+def main_bench():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    size = megabytes * 1024 * 1024
+    context = multiprocessing.get_context("spawn")
+
+    print(f"Upload of {megabytes} MB")
+    for path in PATHS:
+        results = context.Queue()
+        process = context.Process(target=run_upload,
+                                  args=(path, size, results))
+        process.start()
+        status, growth, elapsed = results.get()
+        process.join()
+        print(f"{path:>14}: {status} peak RSS +{growth:7.1f} MB "
+              f"{megabytes / elapsed:7.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -13,9 +13,34 @@ Import File
 
 Import File and UploadFile from fastapi
 '''
-from fastapi import FastAPI, File, UploadFile
+import asyncio
+from typing import Optional
+
+from fastapi import FastAPI, File, Header, HTTPException, Path, Request, \
+    Response, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from blobs import BlobStore, blob_router
+from progress import ProgressRoute, progress_router
+from resumable import MAX_UPLOAD_LENGTH, SESSION_ID_REGEX, \
+    UPLOAD_SESSION_PRUNE_SECONDS, ResumableUploads, UploadSession, \
+    receive_range
+from streaming import save_uploads
 
 app = FastAPI()
+# The uploads are followed while they are received (see progress.py)
+app.router.route_class = ProgressRoute
+upload_progress = ProgressRoute.table
+
+# The uploaded files are kept here, each content once (see blobs.py)
+blob_store = BlobStore()
+# Big files can also be uploaded in pieces (see resumable.py)
+uploads = ResumableUploads(blob_store)
+# HEAD /blobs/{sha256} and the references to the blobs (see blobs.py)
+app.include_router(blob_router(blob_store))
+# GET /uploads/stats and /uploads/{id}/progress, with the resumable uploads
+# (see progress.py)
+app.include_router(progress_router(upload_progress, uploads))
 
 
 # Create file parameters the same way you would for Body or Form:
@@ -27,7 +52,94 @@ async def create_file(file: bytes = File(...)):
 # Define a File parameter with a type of UploadFile:
 @app.post("/uploadfile/")
 async def create_upload_file(file: UploadFile = File(...)):
-    return {"filename": file.filename}
+    sha256, size, ref = await run_in_threadpool(blob_store.add_file,
+                                                file.file)
+    return {"filename": file.filename, "sha256": sha256, "size": size,
+            "ref": ref}
+
+
+# Or read the request body while it arrives, without keeping the files in
+# memory or in temporary files (see streaming.py). As the body is read
+# by the path operation, the files are not declared as parameters and
+# don't show up in the docs.
+@app.post("/streamfiles/")
+async def create_streamed_files(request: Request):
+    return {"files": await save_uploads(request, blob_store)}
+
+
+async def get_session(upload_id: str) -> UploadSession:
+    # Reads what the other workers wrote to it, in a thread
+    session = await run_in_threadpool(uploads.get, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+
+@app.post("/uploads/", status_code=201)
+async def create_upload(response: Response,
+                        upload_length: int = Header(..., ge=0),
+                        filename: Optional[str] = None):
+    if upload_length > MAX_UPLOAD_LENGTH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload-Length is more than {MAX_UPLOAD_LENGTH} bytes")
+    session = await run_in_threadpool(uploads.create, upload_length,
+                                      filename)
+    response.headers["Location"] = f"/uploads/{session.id}"
+    return {"id": session.id, "offset": 0, "length": session.length}
+
+
+@app.head("/uploads/{upload_id}")
+async def read_upload_offset(
+        upload_id: str = Path(..., regex=SESSION_ID_REGEX)):
+    session = await get_session(upload_id)
+    return Response(headers={"Upload-Offset": str(session.offset),
+                             "Upload-Length": str(session.length),
+                             "Cache-Control": "no-store"})
+
+
+@app.patch("/uploads/{upload_id}", status_code=204)
+async def upload_range(request: Request,
+                       upload_id: str = Path(..., regex=SESSION_ID_REGEX),
+                       upload_offset: int = Header(...)):
+    session = await get_session(upload_id)
+    offset = await receive_range(request, session, upload_offset)
+    return Response(status_code=204, headers={"Upload-Offset": str(offset)})
+
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str = Path(..., regex=SESSION_ID_REGEX)):
+    session = await get_session(upload_id)
+    # 409 while a PATCH is writing or if the file is incomplete
+    sha256, size, ref = await run_in_threadpool(uploads.finalize, session)
+    return {"filename": session.filename, "sha256": sha256, "size": size,
+            "ref": ref}
+
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload(upload_id: str = Path(..., regex=SESSION_ID_REGEX)):
+    session = await get_session(upload_id)
+    # Waits for the PATCH requests writing to it
+    if not await run_in_threadpool(uploads.cancel, session):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return Response(status_code=204)
+
+
+async def prune_upload_sessions():
+    while True:
+        await run_in_threadpool(uploads.prune)
+        await asyncio.sleep(UPLOAD_SESSION_PRUNE_SECONDS)
+
+
+@app.on_event("startup")
+async def start_pruning():
+    app.state.prune_task = asyncio.create_task(prune_upload_sessions())
+
+
+@app.on_event("shutdown")
+def close_blob_store():
+    app.state.prune_task.cancel()
+    blob_store.close()
 
 '''
 Info
@@ -0,0 +1,148 @@
+'''
+Parsing multipart/form-data while it is received
+
+await request.form() gives the parts of the form only after the whole body
+is received. iter_multipart() feeds each chunk of the body to the parser
+of python-multipart as soon as it arrives, and yields what it found in it:
+
+    (PART_START, part), (PART_DATA, bytes)..., (PART_END, part)
+
+for each part, so the data of a file can be saved (or refused) before the
+next chunk is received. Only the data is passed on as it comes, the
+headers of a part are kept until they end, so they can't be more than
+MULTIPART_MAX_HEADER_SIZE bytes in total (413). Recent versions of
+python-multipart also limit the count and size of each header (400), older
+ones don't.
+
+There is a copy of this file in the lessons 01 and 02 of 18-Request-Files
+and in 19-Request-Forms-and-Files/01-File-and-Form, so each lesson runs on
+its own. Keep the three the same.
+'''
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+try:
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import MultipartParser, \
+        parse_options_header
+except ImportError:
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+MULTIPART_MAX_HEADER_SIZE = 8 * 1024
+
+PART_START = "part_start"
+PART_DATA = "part_data"
+PART_END = "part_end"
+
+
+class Part:
+    def __init__(self, name: str = "", filename: Optional[str] = None,
+                 content_type: Optional[str] = None):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        # (lowercase name, value), as received
+        self.headers: List[Tuple[bytes, bytes]] = []
+
+
+def is_multipart(request: Request) -> bool:
+    content_type, _ = parse_options_header(
+        request.headers.get("content-type", ""))
+    return content_type == b"multipart/form-data"
+
+
+async def iter_multipart(request: Request) \
+        -> AsyncIterator[Tuple[str, object]]:
+    '''
+    Yields (PART_START, part), (PART_DATA, bytes)... (PART_END, part) for
+    each part of a multipart/form-data body, while it is received.
+    '''
+    content_type, params = parse_options_header(
+        request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400,
+                            detail="Expected multipart/form-data")
+    events: List[Tuple[str, object]] = []
+    part = Part()
+    header_name = b""
+    header_value = b""
+    header_size = 0
+    finished = False
+
+    def count_header(size: int):
+        nonlocal header_size
+        header_size += size
+        if header_size > MULTIPART_MAX_HEADER_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Part headers are larger than "
+                       f"{MULTIPART_MAX_HEADER_SIZE} bytes")
+
+    def on_part_begin():
+        nonlocal part, header_size
+        part = Part()
+        header_size = 0
+
+    def on_header_field(data: bytes, start: int, end: int):
+        nonlocal header_name
+        count_header(end - start)
+        header_name += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        nonlocal header_value
+        count_header(end - start)
+        header_value += data[start:end]
+
+    def on_header_end():
+        nonlocal header_name, header_value
+        part.headers.append((header_name.lower(), header_value))
+        header_name = header_value = b""
+
+    def on_headers_finished():
+        headers = dict(part.headers)
+        _, options = parse_options_header(
+            headers.get(b"content-disposition", b""))
+        part.name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            part.filename = options[b"filename"].decode("utf-8", "replace")
+        if b"content-type" in headers:
+            part.content_type = headers[b"content-type"].decode("latin-1")
+        events.append((PART_START, part))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        events.append((PART_DATA, data[start:end]))
+
+    def on_part_end():
+        events.append((PART_END, part))
+
+    def on_end():
+        nonlocal finished
+        finished = True
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_end": on_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event in events:
+                yield event
+            events.clear()
+        parser.finalize()
+    except FormParserError:
+        finished = False
+    if not finished:
+        # Invalid, or it ended before the last boundary
+        raise HTTPException(status_code=400, detail="Invalid multipart data")
+    for event in events:
+        yield event
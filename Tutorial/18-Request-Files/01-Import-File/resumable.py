@@ -0,0 +1,524 @@
+'''
+Resumable uploads
+
+If the connection drops in the middle of a big upload to /uploadfile/,
+everything sent is lost and the client has to start again from zero.
+Here a file can be uploaded in pieces, with several requests:
+
+    1. POST /uploads/ with the header "Upload-Length: <size of the file>"
+       creates an upload session, and returns its id.
+    2. PATCH /uploads/{id} with the header "Upload-Offset: <offset>" and
+       a piece of the file as the body writes it at that offset. The
+       pieces can be sent in any order, or at the same time.
+    3. If the connection drops, HEAD /uploads/{id} returns in
+       "Upload-Offset" up to where the file was received without gaps, and
+       the client continues from there.
+    4. POST /uploads/{id}/finalize, when all of the file was sent, moves it
+       to the blob store (see blobs.py) and returns its SHA-256 and the
+       id of its reference. Not while a PATCH is still writing (409), and
+       no PATCH is accepted after it started, so the file can't change
+       while it is hashed.
+    5. DELETE /uploads/{id} cancels it. It waits for the PATCH requests
+       still writing, then removes the files.
+
+Each session has, in blobs/sessions:
+
+    * <id>.json: the size and name of the file.
+    * <id>.data: the file. It is created with its final size (without
+      writing anything, so it takes no disk space until it is written),
+      and each PATCH writes its piece in place.
+    * <id>.journal: a line "start end" for each piece written. It is only
+      added after the data is on disk, so after a crash or a restart the
+      journal says what parts of the file are there. Even if a PATCH is
+      interrupted, what it wrote until then is kept.
+
+The sessions not finalized in UPLOAD_SESSION_TTL seconds are removed, and
+a file can't be bigger than MAX_UPLOAD_LENGTH.
+
+Several workers
+
+With several worker processes, the requests of one session can go to any
+of them, so what a worker remembers about a session can be old. Each
+request checks that the .json is still there and reads the journal lines
+added since the last time, by any worker. A PATCH holds a shared lock
+(flock) on the .data file while it writes, finalize and DELETE take an
+exclusive one: finalize gets a 409 instead of hashing a file that is
+still written somewhere, and DELETE waits for the writers to end. Without
+fcntl (Windows), only the requests of this process are seen.
+
+Hashing while receiving
+
+Reading a 10 GB file again to hash it would make finalize slow. A PATCH
+that continues the file right where the hashed part ends (a client
+sending the pieces in order) hashes its data while writing it, and its
+journal line ends with the id of that hash: "start end <hash id>". The
+hash is kept in the memory of the worker, finalize only reads and hashes
+what comes after it. If the journal shows any other write in the hashed
+part (a piece sent again, or written by another worker), the hash can't
+be trusted, and the whole file is hashed.
+'''
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, only the requests of this process are seen there
+    fcntl = None
+
+from blobs import BLOB_CHUNK_SIZE, BlobStore
+
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+UPLOAD_SESSION_PRUNE_SECONDS = 60 * 60
+MAX_UPLOAD_LENGTH = 10 * 1024 ** 3
+
+SESSION_ID_REGEX = "^[0-9a-f]{32}$"
+
+# fdatasync is enough (no need to save the file times), not on macOS
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+
+def add_range(ranges: List[Tuple[int, int]], start: int, end: int):
+    '''
+    Adds [start, end) to the sorted list of ranges, joining the ones that
+    overlap or touch.
+    '''
+    i = bisect.bisect_left(ranges, (start, end))
+    # The one before can overlap too
+    if i > 0 and ranges[i - 1][1] >= start:
+        i -= 1
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        start = min(start, ranges[j][0])
+        end = max(end, ranges[j][1])
+        j += 1
+    ranges[i:j] = [(start, end)]
+
+
+def journal_lines(data: bytes) -> Iterator[Tuple[int, int, str]]:
+    '''
+    (start, end, hash id or "") for each complete line of a journal.
+    '''
+    # The last line could be half written, it has no "\n" yet
+    for line in data.split(b"\n")[:-1]:
+        parts = line.decode("ascii", "replace").split()
+        if len(parts) in (2, 3) and parts[0].isdigit() and \
+                parts[1].isdigit():
+            yield int(parts[0]), int(parts[1]), \
+                parts[2] if len(parts) == 3 else ""
+
+
+def hashed_prefix(lines: List[Tuple[int, int, str]], hash_id: str) -> int:
+    '''
+    Up to where the file was hashed by the requests of hash_id, or 0 if
+    any other write touched that part.
+    '''
+    hashed = 0
+    for start, end, line_hash_id in lines:
+        if line_hash_id == hash_id and start == hashed:
+            hashed = end
+    for start, end, line_hash_id in lines:
+        if line_hash_id != hash_id and start < hashed:
+            return 0
+    return hashed
+
+
+def try_lock(fd: int, exclusive: bool) -> bool:
+    '''
+    Takes a shared or exclusive flock() on the file, or returns False if
+    another request has it. Always True without fcntl.
+    '''
+    if fcntl is None:
+        return True
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class UploadSession:
+    def __init__(self, directory: str, session_id: str, length: int,
+                 filename: Optional[str], created: float):
+        self.id = session_id
+        self.length = length
+        self.filename = filename
+        self.created = created
+        base = os.path.join(directory, session_id)
+        self.meta_path = base + ".json"
+        self.data_path = base + ".data"
+        self.journal_path = base + ".journal"
+        self.ranges: List[Tuple[int, int]] = []
+        # Bytes of the journal already read into ranges
+        self.journal_size = 0
+        self.finalizing = False
+        # PATCH requests of this process writing to the file now
+        self.writers = 0
+        # The SHA-256 of the file from 0 to hashed, made by the PATCH
+        # requests of this process (see "Hashing while receiving")
+        self.hasher = None
+        self.hashed = 0
+        self.hash_id = uuid.uuid4().hex[:8]
+        self.hashing = False
+        self.lock = threading.Lock()
+
+    @property
+    def offset(self) -> int:
+        # Received without gaps from the start
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def complete(self) -> bool:
+        return self.length == 0 or self.ranges == [(0, self.length)]
+
+    def refresh(self):
+        '''
+        Reads the journal lines added since the last time, by this worker
+        or any other.
+        '''
+        with self.lock:
+            with open(self.journal_path, "rb") as journal:
+                journal.seek(self.journal_size)
+                data = journal.read()
+            # Up to the last complete line, the rest is read next time
+            self.journal_size += data.rfind(b"\n") + 1
+            for start, end, _ in journal_lines(data):
+                if start < end <= self.length:
+                    add_range(self.ranges, start, end)
+
+    def start_hashing(self, offset: int):
+        '''
+        The hash to update with the data written from offset, if it's
+        where the hashed part ends and no other request is hashing.
+        '''
+        with self.lock:
+            if self.hashing or offset != self.hashed:
+                return None
+            if self.hasher is None:
+                self.hasher = hashlib.sha256()
+            self.hashing = True
+            return self.hasher
+
+    def record(self, start: int, end: int, hashed: bool = False):
+        '''
+        Adds [start, end) to the journal. With hashed, its data was added
+        to self.hasher too.
+        '''
+        try:
+            if start < end:
+                line = f"{start} {end}"
+                if hashed:
+                    line += f" {self.hash_id}"
+                with self.lock:
+                    with open(self.journal_path, "a") as journal:
+                        journal.write(line + "\n")
+                        journal.flush()
+                        os.fsync(journal.fileno())
+        except BaseException:
+            if hashed:
+                # The journal doesn't show what the hash has
+                self.abort_hashing()
+            raise
+        if hashed:
+            with self.lock:
+                self.hashing = False
+                self.hashed = end
+        self.refresh()
+
+    def abort_hashing(self):
+        '''
+        Drops the hash, the file will be hashed again at finalize.
+        '''
+        with self.lock:
+            self.hasher = None
+            self.hashed = 0
+            # Its lines in the journal don't count anymore
+            self.hash_id = uuid.uuid4().hex[:8]
+            self.hashing = False
+
+
+class ResumableUploads:
+    def __init__(self, store: BlobStore,
+                 ttl: float = UPLOAD_SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+        # In the blob store, to move the finished files there with a rename
+        self.directory = os.path.join(store.directory, "sessions")
+        os.makedirs(self.directory, exist_ok=True)
+        self.sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+
+    def create(self, length: int,
+               filename: Optional[str] = None) -> UploadSession:
+        session = UploadSession(self.directory, uuid.uuid4().hex, length,
+                                filename, time.time())
+        temp_path = session.meta_path + ".tmp"
+        try:
+            with open(session.data_path, "wb") as data:
+                data.truncate(length)
+            open(session.journal_path, "w").close()
+            with open(temp_path, "w") as meta:
+                json.dump({"length": length, "filename": filename,
+                           "created": session.created}, meta)
+            os.replace(temp_path, session.meta_path)
+        except BaseException:
+            # e.g. a length the file system doesn't allow, no files left
+            self.remove(session)
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[UploadSession]:
+        '''
+        The session, up to date with what all the workers wrote to it.
+        Blocking, call it in a thread.
+        '''
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self._load(session_id)
+                if session is not None:
+                    self.sessions[session_id] = session
+        if session is None or time.time() - session.created > self.ttl:
+            return None
+        try:
+            if not os.path.exists(session.meta_path):
+                raise FileNotFoundError(session.meta_path)
+            session.refresh()
+        except FileNotFoundError:
+            # Finalized or removed, maybe by another worker
+            self._forget(session)
+            return None
+        return session
+
+    def _load(self, session_id: str) -> Optional[UploadSession]:
+        # Sessions created by another worker, or before a restart
+        try:
+            with open(os.path.join(self.directory,
+                                   session_id + ".json")) as meta:
+                info = json.load(meta)
+        except FileNotFoundError:
+            return None
+        return UploadSession(self.directory, session_id, info["length"],
+                             info["filename"], info["created"])
+
+    def _forget(self, session: UploadSession):
+        with self._lock:
+            if self.sessions.get(session.id) is session:
+                del self.sessions[session.id]
+
+    def finalize(self, session: UploadSession) -> Tuple[str, int, str]:
+        '''
+        Moves the complete file to the blob store. Returns its SHA-256,
+        size and the id of its reference. Blocking, call it in a thread.
+        '''
+        try:
+            fd = os.open(session.data_path, os.O_RDONLY)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        try:
+            if session.finalizing:
+                raise HTTPException(status_code=409,
+                                    detail="Upload is finalizing")
+            if session.writers or not try_lock(fd, exclusive=True):
+                # The file could still change while it is hashed
+                raise HTTPException(status_code=409,
+                                    detail="Upload is being written")
+            if not os.path.exists(session.meta_path):
+                raise HTTPException(status_code=404,
+                                    detail="Upload not found")
+            session.refresh()
+            if not session.complete:
+                raise HTTPException(
+                    status_code=409, detail="Upload is incomplete",
+                    headers={"Upload-Offset": str(session.offset)})
+            session.finalizing = True
+            try:
+                digest = self._hash(session, fd)
+                ref = self.store.add_path(session.data_path, digest,
+                                          session.length)
+                self.remove(session)
+            finally:
+                session.finalizing = False
+        finally:
+            # Releases the lock, after the session files are gone
+            os.close(fd)
+        return digest, session.length, ref
+
+    def _hash(self, session: UploadSession, fd: int) -> str:
+        with open(session.journal_path, "rb") as journal:
+            lines = list(journal_lines(journal.read()))
+        hashed = hashed_prefix(lines, session.hash_id)
+        # Still hashing: a PATCH ended without recording its piece
+        if session.hasher is not None and not session.hashing and \
+                hashed == session.hashed:
+            # Only the part after it (usually nothing) is read
+            sha256 = session.hasher.copy()
+        else:
+            sha256 = hashlib.sha256()
+            hashed = 0
+        while hashed < session.length:
+            chunk = os.pread(fd, min(BLOB_CHUNK_SIZE,
+                                     session.length - hashed), hashed)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            hashed += len(chunk)
+        return sha256.hexdigest()
+
+    def cancel(self, session: UploadSession) -> bool:
+        '''
+        Removes the session, once the PATCH requests still writing to it
+        end. False if it was already gone. Blocking, call it in a thread.
+        '''
+        # Without the .json the session is gone for new requests
+        try:
+            os.unlink(session.meta_path)
+        except FileNotFoundError:
+            return False
+        self._forget(session)
+        try:
+            fd = os.open(session.data_path, os.O_RDONLY)
+        except FileNotFoundError:
+            # Finalized meanwhile
+            fd = None
+        if fd is not None:
+            try:
+                if fcntl is not None:
+                    # Waits for the writers of all the workers
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            finally:
+                os.close(fd)
+        while session.writers:
+            # Without fcntl, at least those of this process
+            time.sleep(0.01)
+        self.remove(session)
+        return True
+
+    def remove(self, session: UploadSession):
+        self._forget(session)
+        # The .json last, without it the rest is not a session anymore
+        for path in (session.data_path, session.journal_path,
+                     session.meta_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            session_id, ext = os.path.splitext(name)
+            path = os.path.join(self.directory, name)
+            if ext == ".json":
+                with self._lock:
+                    session = self.sessions.get(session_id) or \
+                        self._load(session_id)
+                if session is not None and now - session.created > self.ttl:
+                    self.remove(session)
+            elif not os.path.exists(os.path.join(self.directory,
+                                                 session_id + ".json")):
+                # Left by a crash while creating or removing a session
+                try:
+                    if now - os.path.getmtime(path) > self.ttl:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _write_piece(fd: int, data: bytes, offset: int, hasher):
+    _pwrite_all(fd, data, offset)
+    if hasher is not None:
+        # After the write, the hash only has what is in the file
+        hasher.update(data)
+
+
+async def receive_range(request: Request, session: UploadSession,
+                        offset: int) -> int:
+    '''
+    Writes the body of the request in the session file from offset, and
+    returns the new session offset.
+    '''
+    if session.finalizing:
+        raise HTTPException(status_code=409, detail="Upload is finalizing")
+    if not 0 <= offset <= session.length:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Offset")
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and \
+            offset + int(content_length) > session.length:
+        raise HTTPException(status_code=413,
+                            detail="Body goes past Upload-Length")
+    # Counted before the first await, finalize() sees it
+    session.writers += 1
+    try:
+        try:
+            fd = await run_in_threadpool(os.open, session.data_path,
+                                         os.O_WRONLY)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        try:
+            if not await run_in_threadpool(try_lock, fd, False):
+                raise HTTPException(status_code=409,
+                                    detail="Upload is finalizing")
+            # Finalized or removed before the lock was taken
+            if not await run_in_threadpool(os.path.exists,
+                                           session.meta_path):
+                raise HTTPException(status_code=404,
+                                    detail="Upload not found")
+            hasher = session.start_hashing(offset)
+            written = 0
+            try:
+                async for chunk in request.stream():
+                    if offset + written + len(chunk) > session.length:
+                        raise HTTPException(
+                            status_code=413,
+                            detail="Body goes past Upload-Length")
+                    await run_in_threadpool(_write_piece, fd, chunk,
+                                            offset + written, hasher)
+                    written += len(chunk)
+            finally:
+                # Also when the client disconnects, what arrived is kept
+                try:
+                    await run_in_threadpool(_datasync, fd)
+                except BaseException:
+                    if hasher is not None:
+                        session.abort_hashing()
+                    raise
+                await run_in_threadpool(session.record, offset,
+                                        offset + written,
+                                        hasher is not None)
+        finally:
+            # Releases the lock, after the journal has the piece
+            await run_in_threadpool(os.close, fd)
+    finally:
+        session.writers -= 1
+    return session.offset
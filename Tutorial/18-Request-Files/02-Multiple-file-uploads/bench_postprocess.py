@@ -0,0 +1,126 @@
+'''
+Post-processing benchmark
+
+Wall clock time to upload a number of files in one request and get the
+result of process_file() (postprocess.py) for each one:
+
+    * serial: files: List[UploadFile], then each file is stored and
+      processed, one after the other.
+    * parallel: /processfiles/, each file is processed in the pool of
+      processes while the next ones are received.
+
+The app is called directly with ASGI messages, no server or HTTP client,
+and the request body is generated while it is sent. The files are
+written to a blob store in a temporary directory that is removed at the
+end. The difference depends on the number of CPU cores, with only one
+the parallel version can only overlap the work with receiving the files.
+
+Run it with:
+
+$ python bench_postprocess.py [files] [megabytes per file]
+'''
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+from fastapi import File, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+BOUNDARY = b"----bench-postprocess-boundary"
+CHUNK_SIZE = 64 * 1024
+
+
+def make_scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"test"),
+            (b"content-type",
+             b"multipart/form-data; boundary=" + BOUNDARY),
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("test", 80),
+    }
+
+
+def body_chunks(files: int, size: int):
+    for n in range(files):
+        yield (b"--" + BOUNDARY + b"\r\n"
+               b'Content-Disposition: form-data; name="files"; '
+               b'filename="file%d.bin"\r\n'
+               b"Content-Type: application/octet-stream\r\n\r\n" % n)
+        # Half random, half zeros, something to compress; and different
+        # for each file, so they are not deduplicated
+        for _ in range(size // CHUNK_SIZE):
+            yield os.urandom(CHUNK_SIZE // 2) + bytes(CHUNK_SIZE // 2)
+        yield b"\r\n"
+    yield b"--" + BOUNDARY + b"--\r\n"
+
+
+async def upload(app, path: str, files: int, size: int) -> int:
+    chunks = body_chunks(files, size)
+    status = None
+
+    async def receive():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return {"type": "http.request", "body": b"", "more_body": False}
+        return {"type": "http.request", "body": chunk, "more_body": True}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(make_scope(path), receive, send)
+    return status
+
+
+def main_bench():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    size = megabytes * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Before importing the app, it creates its blob store here
+        os.chdir(directory)
+        from main import app, blob_store, post_processor
+        from postprocess import process_file
+        # Without a server, the startup handlers don't run
+        post_processor.start()
+
+        @app.post("/serialfiles/")
+        async def create_serial_files(files: List[UploadFile] = File(...)):
+            results = []
+            for file in files:
+                sha256, _, _ = await run_in_threadpool(blob_store.add_file,
+                                                       file.file)
+                results.append(await run_in_threadpool(
+                    process_file, blob_store.path(sha256)))
+            return results
+
+        print(f"{files} files of {megabytes} MB, "
+              f"{os.cpu_count()} CPU cores")
+        for label, path in (("serial", "/serialfiles/"),
+                            ("parallel", "/processfiles/")):
+            start = time.perf_counter()
+            status = asyncio.run(upload(app, path, files, size))
+            elapsed = time.perf_counter() - start
+            print(f"{label:>9}: {status} {elapsed:6.2f} s")
+        post_processor.shutdown()
+        blob_store.close()
+
+
+if __name__ == "__main__":
+    main_bench()
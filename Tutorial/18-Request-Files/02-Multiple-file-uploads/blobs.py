@@ -0,0 +1,253 @@
+'''
+Content addressed blob store
+
+Each uploaded file is saved with its SHA-256 as its name, so the same
+content uploaded many times (by one or many clients) is stored once.
+
+    blobs/
+        3a/
+            7b/
+                3a7b...  (the whole SHA-256)
+        tmp/
+        blobs.db
+
+    * The files are spread in directories by the first bytes of their
+      hash, so no directory gets millions of entries.
+    * The data is written to a temporary file in blobs/tmp while it is
+      hashed, and moved to its place with a rename when complete. A
+      rename in the same file system is atomic, a blob is either there
+      complete or not there at all.
+    * A small SQLite database keeps the references to each blob: each
+      upload adds one, release() removes one, and the file is deleted
+      when nothing references it.
+
+Each reference has its own random id (the "ref" returned with the
+upload), and only that id can release it. Knowing the SHA-256 of some
+content is not enough to make the blob of another client go away.
+
+Before uploading, a client can ask with HEAD /blobs/{sha256} if the
+server already has some content, and skip sending it. It then takes its
+own reference with POST /blobs/{sha256}/refs, and gives it back with
+DELETE /blobs/{sha256}/refs/{ref}. blob_router() has these routes.
+
+The lessons 01 and 02 of 18-Request-Files each have a copy of this file,
+keep both the same.
+'''
+import hashlib
+import os
+import re
+import secrets
+import sqlite3
+import tempfile
+import threading
+from typing import BinaryIO, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Path, Response
+from starlette.concurrency import run_in_threadpool
+
+BLOB_DIR = "blobs"
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+SHA256_REGEX = "^[0-9a-f]{64}$"
+REF_REGEX = "^[0-9a-f]{32}$"
+_sha256_re = re.compile(SHA256_REGEX)
+
+
+class BlobWriter:
+    def __init__(self, temp_dir: str):
+        fd, self.temp_path = tempfile.mkstemp(dir=temp_dir)
+        self.file = os.fdopen(fd, "wb")
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.sha256.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.temp_path)
+
+
+class BlobStore:
+    def __init__(self, directory: str = BLOB_DIR):
+        self.directory = directory
+        self.temp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # One connection for all the threads, only used with self._lock
+        self.db = sqlite3.connect(os.path.join(directory, "blobs.db"),
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " sha256 TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blob_refs ("
+            " ref TEXT PRIMARY KEY,"
+            " sha256 TEXT NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS blob_refs_sha256"
+                        " ON blob_refs (sha256)")
+        self._lock = threading.Lock()
+
+    def path(self, sha256: str) -> str:
+        if not _sha256_re.match(sha256):
+            raise ValueError(f"Invalid SHA-256: {sha256!r}")
+        return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256)
+
+    def size(self, sha256: str) -> Optional[int]:
+        with self._lock:
+            return self._size(sha256)
+
+    def _size(self, sha256: str) -> Optional[int]:
+        row = self.db.execute("SELECT size FROM blobs WHERE sha256 = ?",
+                              (sha256,)).fetchone()
+        return None if row is None else row[0]
+
+    def _new_ref(self, sha256: str) -> str:
+        ref = secrets.token_hex(16)
+        self.db.execute("INSERT INTO blob_refs (ref, sha256) VALUES (?, ?)",
+                        (ref, sha256))
+        return ref
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self.temp_dir)
+
+    def commit(self, writer: BlobWriter) -> Tuple[str, int, str]:
+        '''
+        Saves the blob written with writer, if it's not there yet, and
+        adds one reference to it. Returns its SHA-256, size and the id of
+        the reference.
+        '''
+        writer.file.close()
+        sha256 = writer.sha256.hexdigest()
+        ref = self.add_path(writer.temp_path, sha256, writer.size)
+        return sha256, writer.size, ref
+
+    def add_path(self, temp_path: str, sha256: str, size: int) -> str:
+        '''
+        Moves the complete file at temp_path (in the same file system) to
+        the store as the blob sha256, or removes it if the store already
+        has it, and returns a new reference to the blob.
+        '''
+        path = self.path(sha256)
+        # The lock for the threads of this process, the transaction
+        # (BEGIN IMMEDIATE) for other processes using the same store
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._size(sha256) is None:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temp_path, path)
+                    self.db.execute(
+                        "INSERT INTO blobs (sha256, size) VALUES (?, ?)",
+                        (sha256, size))
+                else:
+                    os.unlink(temp_path)
+                ref = self._new_ref(sha256)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return ref
+
+    def add_file(self, file: BinaryIO) -> Tuple[str, int, str]:
+        writer = self.writer()
+        try:
+            while True:
+                data = file.read(BLOB_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        return self.commit(writer)
+
+    def add_ref(self, sha256: str) -> Optional[str]:
+        '''
+        Adds one reference to a blob that is already stored, and returns
+        its id. None if there is no such blob.
+        '''
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                ref = None
+                if self._size(sha256) is not None:
+                    ref = self._new_ref(sha256)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return ref
+
+    def release(self, sha256: str, ref: str) -> bool:
+        '''
+        Removes the reference ref to the blob, and the blob with the last
+        one. Returns False if there was no such reference.
+        '''
+        path = self.path(sha256)
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.db.execute(
+                    "DELETE FROM blob_refs WHERE ref = ? AND sha256 = ?",
+                    (ref, sha256))
+                if cursor.rowcount == 0:
+                    self.db.execute("COMMIT")
+                    return False
+                row = self.db.execute(
+                    "SELECT 1 FROM blob_refs WHERE sha256 = ? LIMIT 1",
+                    (sha256,)).fetchone()
+                if row is None:
+                    self.db.execute("DELETE FROM blobs WHERE sha256 = ?",
+                                    (sha256,))
+                    os.unlink(path)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return True
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def blob_router(store: BlobStore) -> APIRouter:
+    '''
+    The routes of the blobs in store, for app.include_router().
+    '''
+    router = APIRouter()
+
+    # 200 (with the size in Content-Length) if the content is already
+    # stored, so the client doesn't need to upload it again, 404 if not
+    @router.head("/blobs/{sha256}")
+    async def check_blob(sha256: str = Path(..., regex=SHA256_REGEX)):
+        size = await run_in_threadpool(store.size, sha256)
+        if size is None:
+            raise HTTPException(status_code=404, detail="Blob not found")
+        return Response(headers={"Content-Length": str(size)})
+
+    # A new reference to a blob the server already has (see HEAD above),
+    # instead of uploading it again
+    @router.post("/blobs/{sha256}/refs", status_code=201)
+    async def add_blob_ref(sha256: str = Path(..., regex=SHA256_REGEX)):
+        ref = await run_in_threadpool(store.add_ref, sha256)
+        if ref is None:
+            raise HTTPException(status_code=404, detail="Blob not found")
+        return {"sha256": sha256, "ref": ref}
+
+    # Gives back a reference, the blob is deleted with the last one
+    @router.delete("/blobs/{sha256}/refs/{ref}", status_code=204)
+    async def release_blob_ref(sha256: str = Path(..., regex=SHA256_REGEX),
+                               ref: str = Path(..., regex=REF_REGEX)):
+        if not await run_in_threadpool(store.release, sha256, ref):
+            raise HTTPException(status_code=404,
+                                detail="Reference not found")
+        return Response(status_code=204)
+
+    return router
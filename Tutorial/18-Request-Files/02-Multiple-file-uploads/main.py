@@ -6,10 +6,29 @@ They would be associated to the same "form field" sent using "form data".
 To use that, declare a List of bytes or UploadFile.
 '''
 from typing import List
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Request, UploadFile
 from fastapi.responses import HTMLResponse
+from starlette.concurrency import run_in_threadpool
+
+from blobs import BlobStore, blob_router
+from postprocess import PostProcessor
+from progress import ProgressRoute, progress_router
+from streaming import iter_saved_uploads, release_uploads
 
 app = FastAPI()
+# The uploads are followed while they are received (see progress.py), with
+# the header "Upload-Id: {id}" a client can see the progress of its own
+app.router.route_class = ProgressRoute
+upload_progress = ProgressRoute.table
+
+# The uploaded files are kept here, each content once (see blobs.py)
+blob_store = BlobStore()
+# HEAD /blobs/{sha256} and the references to the blobs (see blobs.py)
+app.include_router(blob_router(blob_store))
+# GET /uploads/stats and /uploads/{id}/progress (see progress.py)
+app.include_router(progress_router(upload_progress))
+# Processes the files while the next ones are received (see postprocess.py)
+post_processor = PostProcessor()
 
 
 @app.post("/files/")
@@ -19,7 +38,53 @@ async def create_files(files: List[bytes] = File(...)):
 
 @app.post("/uploadfiles/")
 async def create_upload_files(files: List[UploadFile] = File(...)):
-    return {"filenames": [file.filename for file in files]}
+    saved = []
+    try:
+        for file in files:
+            sha256, size, ref = await run_in_threadpool(blob_store.add_file,
+                                                        file.file)
+            saved.append({"filename": file.filename, "sha256": sha256,
+                          "size": size, "ref": ref})
+    except BaseException:
+        # The client never gets the references of the files saved before
+        await release_uploads(blob_store, saved)
+        raise
+    return {"files": saved}
+
+
+# The same, but each file is processed (in another process) as soon as it
+# is received, while the next ones are still being received
+@app.post("/processfiles/")
+async def create_processed_files(request: Request):
+    pending = []
+    try:
+        async for saved in iter_saved_uploads(request, blob_store):
+            future = await post_processor.submit(
+                blob_store.path(saved["sha256"]))
+            pending.append((saved, future))
+        return {"files": [dict(saved, **await future)
+                          for saved, future in pending]}
+    except BaseException:
+        for _, future in pending:
+            future.cancel()
+        # Those given back already by iter_saved_uploads() are not found
+        await release_uploads(blob_store, [saved for saved, _ in pending])
+        raise
+
+
+@app.on_event("startup")
+def start_post_processor():
+    post_processor.start()
+
+
+@app.on_event("shutdown")
+def stop_post_processor():
+    post_processor.shutdown()
+
+
+@app.on_event("shutdown")
+def close_blob_store():
+    blob_store.close()
 
 
 @app.get("/")
@@ -34,6 +99,10 @@ async def main():
 <input name="files" type="file" multiple>
 <input type="submit">
 </form>
+<form action="/processfiles/" enctype="multipart/form-data" method="post">
+<input name="files" type="file" multiple>
+<input type="submit">
+</form>
 </body>
     """
     return HTMLResponse(content=content)
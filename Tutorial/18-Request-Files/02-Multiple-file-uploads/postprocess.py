@@ -0,0 +1,112 @@
+'''
+Processing uploaded files in parallel
+
+With files: List[UploadFile], the path operation only starts when all the
+files were received, and then handles them one after the other. If each
+file needs CPU work (checking, making a thumbnail, compressing...), the
+total time is the upload plus the work of every file, one by one.
+
+Here the files are received with streaming.py, and as soon as a file is
+complete it is sent to a pool of processes, while the next one is still
+being received. The work of the files runs in parallel, in several CPU
+cores (processes, not threads, so the GIL doesn't get in the way), and at
+the same time as the upload.
+
+The pool is bounded: it runs POSTPROCESS_WORKERS files at a time, and
+when POSTPROCESS_MAX_PENDING are waiting, the path operation stops reading
+the request until one finishes. A fast client can't pile up work without
+limit, TCP makes it wait.
+
+Only the path of the file goes to the worker process, it reads the file
+itself, the data is not copied between processes.
+
+The pool is created by start(), in the startup of the app, and its
+processes are started with "forkserver" (or "spawn" where there is no
+forkserver). A fork of the server itself, with its threads and their
+locks in any state, could hang. shutdown() stops it when the app stops.
+'''
+import asyncio
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+POSTPROCESS_WORKERS = os.cpu_count() or 1
+POSTPROCESS_MAX_PENDING = 2 * POSTPROCESS_WORKERS
+POSTPROCESS_CHUNK_SIZE = 1024 * 1024
+THUMBNAIL_SIZE = 64
+POSTPROCESS_START_METHOD = "forkserver" \
+    if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def process_file(path: str) -> dict:
+    '''
+    The CPU work for one file, in a worker process: a CRC-32, the size it
+    would have compressed, and a "thumbnail" (the file shrunk to
+    THUMBNAIL_SIZE values, the average of each block of bytes).
+    '''
+    size = os.path.getsize(path)
+    block_size = max(1, -(-size // THUMBNAIL_SIZE))
+    crc32 = 0
+    compressor = zlib.compressobj(6)
+    compressed_size = 0
+    thumbnail = []
+    block_sum = block_count = 0
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(POSTPROCESS_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc32 = zlib.crc32(chunk, crc32)
+            compressed_size += len(compressor.compress(chunk))
+            view = memoryview(chunk)
+            while view:
+                part = view[:block_size - block_count]
+                block_sum += sum(part)
+                block_count += len(part)
+                view = view[len(part):]
+                if block_count == block_size:
+                    thumbnail.append(block_sum // block_count)
+                    block_sum = block_count = 0
+    compressed_size += len(compressor.flush())
+    if block_count:
+        thumbnail.append(block_sum // block_count)
+    return {
+        "crc32": f"{crc32:08x}",
+        "compressed_size": compressed_size,
+        "thumbnail": bytes(thumbnail).hex(),
+    }
+
+
+class PostProcessor:
+    def __init__(self,
+                 workers: int = POSTPROCESS_WORKERS,
+                 max_pending: int = POSTPROCESS_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self._slots = None
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(POSTPROCESS_START_METHOD))
+
+    async def submit(self, path: str) -> asyncio.Future:
+        '''
+        Starts processing the file at path, and returns the future with its
+        result. Waits first if max_pending files are already waiting.
+        '''
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.pool, process_file, path)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
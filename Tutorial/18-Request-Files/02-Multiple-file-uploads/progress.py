@@ -0,0 +1,285 @@
+'''
+Upload progress
+
+ProgressRoute follows the body of every upload while it is received, in
+a table shared by all the requests (ProgressTable):
+
+    * For each upload: the bytes received, the total (if known), the rate
+      and the time left (ETA). GET /uploads/{id}/progress shows it, while
+      the upload is running and for PROGRESS_KEEP_SECONDS after it ends.
+    * For all of them: the bytes per second of the last
+      PROGRESS_WINDOW_SECONDS, in GET /uploads/stats.
+
+The id of an upload is the {upload_id} of the path (PATCH /uploads/{id}),
+or else an "Upload-Id" header chosen by the client (32 hex characters,
+like uuid.uuid4().hex), so it can ask for the progress of its POST
+/uploadfile/ while it is sent. Without it (or with an invalid one) the
+upload only counts in the stats, it has no entry in the table. The ids
+of the path are made by the server, the "Upload-Id" ones are kept with
+the address of the client, so a client can't see or replace the entries
+of the others by sending their ids.
+
+For a resumable upload (see resumable.py of 01-Import-File), "received"
+comes from its session, all that the server has of the file, whatever
+request sent it. The table only gives the rate of the last PATCH, and
+the ETA from it.
+
+progress_router() has the routes. 01-Import-File and
+02-Multiple-file-uploads have the same copy of this file.
+
+Where the time goes shows the bottleneck: the time waiting for the next
+chunk from the client is "network_seconds", the time between getting a
+chunk and asking for the next one (parsing, hashing, writing it to disk)
+is "server_seconds". If uploads spend most of their time on the server
+side, the disk (or the CPU) is slower than the network.
+'''
+import re
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException, Path
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+PROGRESS_WINDOW_SECONDS = 10
+PROGRESS_KEEP_SECONDS = 60
+
+UPLOAD_ID_REGEX = "^[0-9a-f]{32}$"
+
+_upload_id = re.compile(UPLOAD_ID_REGEX)
+
+
+class UploadProgress:
+    def __init__(self, upload_id: Optional[str], offset: int,
+                 total: Optional[int]):
+        self.id = upload_id
+        # Where the body starts in the upload (Upload-Offset), and where it
+        # ends
+        self.offset = offset
+        self.total = total
+        self.received = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.network_seconds = 0.0
+        self.server_seconds = 0.0
+
+    def as_dict(self, total: Optional[int] = None,
+                done: Optional[int] = None) -> dict:
+        '''
+        With total and done, the size of the upload and what the server has
+        of it, instead of what this request said and sent.
+        '''
+        end = self.finished or time.monotonic()
+        elapsed = end - self.started
+        rate = self.received / elapsed if elapsed > 0 else 0.0
+        total = total if total is not None else self.total
+        if done is None:
+            done = self.offset + self.received
+        eta = None
+        if self.finished is None and total is not None and rate > 0:
+            eta = max(0, total - done) / rate
+        return {
+            "id": self.id,
+            "received": done,
+            "total": total,
+            "bytes_per_second": round(rate),
+            "eta_seconds": None if eta is None else round(eta, 1),
+            "elapsed_seconds": round(elapsed, 3),
+            "network_seconds": round(self.network_seconds, 3),
+            "server_seconds": round(self.server_seconds, 3),
+            # Receiving this request now
+            "active": self.finished is None,
+        }
+
+
+class ProgressTable:
+    def __init__(self, window: int = PROGRESS_WINDOW_SECONDS,
+                 keep: float = PROGRESS_KEEP_SECONDS):
+        self.window = window
+        self.keep = keep
+        self.uploads: Dict[str, UploadProgress] = {}
+        # [second, bytes] of the last window seconds
+        self._buckets: Deque[List[int]] = deque()
+        self._last_prune = time.monotonic()
+        self.bytes_total = 0
+        self.uploads_total = 0
+        # Receiving now, with an id or not
+        self.active = 0
+        self.network_seconds = 0.0
+        self.server_seconds = 0.0
+
+    def get(self, upload_id: str) -> Optional[UploadProgress]:
+        return self.uploads.get(upload_id)
+
+    def start(self, upload_id: Optional[str], offset: int,
+              total: Optional[int]) -> UploadProgress:
+        '''
+        A new upload, in the table if it has an id.
+        '''
+        now = time.monotonic()
+        if now - self._last_prune > self.keep:
+            self.prune(now)
+        progress = UploadProgress(upload_id, offset, total)
+        if upload_id is not None:
+            self.uploads[upload_id] = progress
+        self.uploads_total += 1
+        return progress
+
+    def prune(self, now: float):
+        self._last_prune = now
+        for upload_id, progress in list(self.uploads.items()):
+            if progress.finished is not None and \
+                    now - progress.finished > self.keep:
+                del self.uploads[upload_id]
+
+    def _count(self, size: int, now: float):
+        second = int(now)
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += size
+        else:
+            self._buckets.append([second, size])
+        while self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+        self.bytes_total += size
+
+    async def track(self, progress: UploadProgress,
+                    chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        '''
+        Yields the chunks of the body, counting them in progress and in
+        the stats.
+        '''
+        self.active += 1
+        try:
+            while True:
+                asked = time.monotonic()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                received = time.monotonic()
+                progress.network_seconds += received - asked
+                progress.received += len(chunk)
+                self._count(len(chunk), received)
+                yield chunk
+                progress.server_seconds += time.monotonic() - received
+        finally:
+            # Also when the client disconnects or the body is refused
+            progress.finished = time.monotonic()
+            self.active -= 1
+            self.network_seconds += progress.network_seconds
+            self.server_seconds += progress.server_seconds
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        second = int(now)
+        recent = sum(size for bucket_second, size in self._buckets
+                     if bucket_second > second - self.window)
+        return {
+            "active_uploads": self.active,
+            "bytes_per_second": round(recent / self.window),
+            "window_seconds": self.window,
+            "bytes_total": self.bytes_total,
+            "uploads_total": self.uploads_total,
+            "network_seconds": round(self.network_seconds, 3),
+            "server_seconds": round(self.server_seconds, 3),
+        }
+
+
+def client_upload_id(request: Request, upload_id: str) -> str:
+    '''
+    The key in the table of an "Upload-Id" sent by the client of request.
+    '''
+    host = request.client.host if request.client else ""
+    return f"{host}/{upload_id}"
+
+
+def _int_header(request: Request, name: str) -> Optional[int]:
+    value = request.headers.get(name)
+    return int(value) if value is not None and value.isdigit() else None
+
+
+class ProgressRequest(Request):
+    def __init__(self, scope, receive, table: ProgressTable):
+        super().__init__(scope, receive)
+        self.table = table
+        self._tracked = False
+
+    def stream(self) -> AsyncIterator[bytes]:
+        chunks = super().stream()
+        if self._tracked or hasattr(self, "_body"):
+            return chunks
+        self._tracked = True
+        # Made by the server, or else sent by the client
+        upload_id = self.path_params.get("upload_id", "")
+        if not _upload_id.match(upload_id):
+            upload_id = self.headers.get("upload-id", "")
+            if _upload_id.match(upload_id):
+                upload_id = client_upload_id(self, upload_id)
+            else:
+                # Only counted in the stats
+                upload_id = None
+        offset = _int_header(self, "upload-offset") or 0
+        length = _int_header(self, "content-length")
+        total = offset + length if length is not None else None
+        progress = self.table.start(upload_id, offset, total)
+        return self.table.track(progress, chunks)
+
+
+class ProgressRoute(APIRoute):
+    # The same table for all the routes
+    table = ProgressTable()
+
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+        table = self.table
+
+        async def progress_route_handler(request: Request):
+            if request.method in ("POST", "PUT", "PATCH") and \
+                    request.headers.get("content-length", "1") != "0":
+                request = ProgressRequest(request.scope, request.receive,
+                                          table)
+            return await original_route_handler(request)
+
+        return progress_route_handler
+
+
+def progress_router(table: ProgressTable, sessions=None) -> APIRouter:
+    '''
+    The routes of the uploads in table, for app.include_router(). sessions
+    are the resumable uploads (ResumableUploads of resumable.py), if the
+    app has them.
+    '''
+    router = APIRouter()
+
+    # All the uploads together: bytes per second of the last seconds, and
+    # where the time went
+    @router.get("/uploads/stats")
+    async def read_upload_stats():
+        return table.stats()
+
+    # The upload being received (or received in the last minute) with this
+    # id: a resumable one, or any other this client sent with the header
+    # "Upload-Id: {id}"
+    @router.get("/uploads/{upload_id}/progress")
+    async def read_upload_progress(
+            request: Request,
+            upload_id: str = Path(..., regex=UPLOAD_ID_REGEX)):
+        session = None
+        if sessions is not None:
+            session = await run_in_threadpool(sessions.get, upload_id)
+        if session is None:
+            progress = table.get(client_upload_id(request, upload_id))
+            if progress is None:
+                raise HTTPException(status_code=404,
+                                    detail="Upload not found")
+            return progress.as_dict()
+        progress = table.get(upload_id)
+        if progress is None:
+            # A resumable upload without a request in the last minute
+            progress = UploadProgress(upload_id, 0, None)
+            progress.finished = progress.started
+        return progress.as_dict(total=session.length, done=session.received)
+
+    return router
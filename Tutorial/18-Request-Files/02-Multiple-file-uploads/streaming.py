@@ -0,0 +1,99 @@
+'''
+Streaming uploads
+
+With file: bytes the whole file is in memory, and with UploadFile it is
+first copied to a SpooledTemporaryFile (in memory up to 1 MB, then on
+disk), and only after the whole request is received the path operation
+can read it again to do something with it.
+
+Here the request body is parsed while it is received, one chunk at a
+time, and the data of each file goes straight to the blob store (see
+blobs.py), computing its size and SHA-256 on the way. Memory use is the
+same for a 1 KB or a 10 GB file, and each byte is read once.
+
+A multipart/form-data body (what browsers send) can have several files,
+the form fields without a file are skipped. Any other body is saved as
+one file. The parser is in multipart_stream.py.
+
+01-Import-File and 02-Multiple-file-uploads have the same copy of this
+file.
+'''
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+from blobs import BlobStore, BlobWriter
+from multipart_stream import PART_DATA, PART_END, PART_START, Part, \
+    is_multipart, iter_multipart
+
+
+async def iter_body(request: Request) -> AsyncIterator[Tuple[str, object]]:
+    '''
+    The same events as iter_multipart, for any body: one part with all of
+    it.
+    '''
+    if is_multipart(request):
+        async for event in iter_multipart(request):
+            yield event
+        return
+    part = Part(name="file", filename="",
+                content_type=request.headers.get("content-type"))
+    yield PART_START, part
+    async for chunk in request.stream():
+        if chunk:
+            yield PART_DATA, chunk
+    yield PART_END, part
+
+
+async def iter_saved_uploads(request: Request, store: BlobStore) \
+        -> AsyncIterator[dict]:
+    '''
+    Yields each file of the request as soon as it is saved in store, while
+    the rest of the request is still being received. If the request fails
+    after some files, their references are given back.
+    '''
+    writer: Optional[BlobWriter] = None
+    saved: List[dict] = []
+    try:
+        async for event, value in iter_body(request):
+            if event == PART_START:
+                if value.filename is not None:
+                    writer = await run_in_threadpool(store.writer)
+            elif event == PART_DATA:
+                if writer is not None:
+                    # hashlib and the file write release the GIL, the
+                    # event loop keeps running while they work
+                    await run_in_threadpool(writer.write, value)
+            elif writer is not None:
+                sha256, size, ref = await run_in_threadpool(store.commit,
+                                                            writer)
+                writer = None
+                saved.append({
+                    "field": value.name,
+                    "filename": value.filename,
+                    "content_type": value.content_type,
+                    "size": size,
+                    "sha256": sha256,
+                    "ref": ref,
+                })
+                yield saved[-1]
+    except BaseException:
+        await release_uploads(store, saved)
+        raise
+    finally:
+        # The client disconnected or sent invalid data
+        if writer is not None:
+            await run_in_threadpool(writer.abort)
+
+
+async def release_uploads(store: BlobStore, saved: List[dict]):
+    '''
+    Gives back the references of files saved for a request that failed.
+    '''
+    for item in saved:
+        await run_in_threadpool(store.release, item["sha256"], item["ref"])
+
+
+async def save_uploads(request: Request, store: BlobStore):
+    return [saved async for saved in iter_saved_uploads(request, store)]
@@ -0,0 +1,146 @@
+'''
+Form size limits
+
+Without limits, a client can send a form with a 10 GB "file" part (kept
+in memory if it's declared as bytes), or a 10 GB "token" field, and the
+path operation only runs after all of it was received.
+
+LimitedFormRoute checks the sizes while the body is received and parsed,
+and answers 413 (Request Entity Too Large) as soon as a limit is passed,
+without reading the rest:
+
+    * max_request_size: the whole body. Checked first with the
+      Content-Length header, before reading anything, and then counting
+      the bytes received (the header can be missing or wrong).
+    * max_file_size: each file part.
+    * max_field_size: each form field that is not a file.
+    * spool_max_size: how much of each file is kept in memory, after that
+      the UploadFile (a SpooledTemporaryFile) moves it to a temporary file
+      on disk.
+
+Set it with app.router.route_class = LimitedFormRoute before declaring the
+path operations. To change the limits, use a subclass with other limits:
+
+    class BigUploadsRoute(LimitedFormRoute):
+        limits = FormLimits(max_file_size=1024 ** 3)
+'''
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starlette.requests import Request
+
+try:
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    from multipart.multipart import parse_options_header
+
+FORM_MAX_REQUEST_SIZE = 50 * 1024 * 1024
+FORM_MAX_FILE_SIZE = 20 * 1024 * 1024
+FORM_MAX_FIELD_SIZE = 64 * 1024
+FORM_SPOOL_MAX_SIZE = 1024 * 1024
+FORM_MAX_FILES = 10
+FORM_MAX_FIELDS = 100
+
+
+class FormLimits:
+    def __init__(self,
+                 max_request_size: int = FORM_MAX_REQUEST_SIZE,
+                 max_file_size: int = FORM_MAX_FILE_SIZE,
+                 max_field_size: int = FORM_MAX_FIELD_SIZE,
+                 spool_max_size: int = FORM_SPOOL_MAX_SIZE,
+                 max_files: int = FORM_MAX_FILES,
+                 max_fields: int = FORM_MAX_FIELDS):
+        self.max_request_size = max_request_size
+        self.max_file_size = max_file_size
+        self.max_field_size = max_field_size
+        self.spool_max_size = spool_max_size
+        self.max_files = max_files
+        self.max_fields = max_fields
+
+
+def too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+class LimitedMultiPartParser(MultiPartParser):
+    def __init__(self, headers, stream, limits: FormLimits):
+        super().__init__(headers, stream,
+                         max_files=limits.max_files,
+                         max_fields=limits.max_fields,
+                         max_part_size=limits.max_field_size)
+        self.limits = limits
+        self.spool_max_size = limits.spool_max_size
+        self._part_size = 0
+
+    def on_part_begin(self):
+        super().on_part_begin()
+        self._part_size = 0
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self._part_size += end - start
+        part = self._current_part
+        if part.file is not None:
+            if self._part_size > self.limits.max_file_size:
+                raise too_large(f"File {part.field_name!r} is larger than "
+                                f"{self.limits.max_file_size} bytes")
+        elif self._part_size > self.limits.max_field_size:
+            raise too_large(f"Field {part.field_name!r} is larger than "
+                            f"{self.limits.max_field_size} bytes")
+        super().on_part_data(data, start, end)
+
+
+class LimitedFormRequest(Request):
+    def __init__(self, scope, receive, limits: FormLimits):
+        super().__init__(scope, receive)
+        self.limits = limits
+
+    async def stream(self):
+        limit = self.limits.max_request_size
+        content_length = self.headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and \
+                int(content_length) > limit:
+            raise too_large(f"Body is larger than {limit} bytes")
+        received = 0
+        async for chunk in super().stream():
+            received += len(chunk)
+            if received > limit:
+                raise too_large(f"Body is larger than {limit} bytes")
+            yield chunk
+
+    async def _get_form(self, **kwargs):
+        content_type, _ = parse_options_header(
+            self.headers.get("content-type"))
+        if content_type != b"multipart/form-data":
+            return await super()._get_form(
+                max_fields=self.limits.max_fields,
+                max_part_size=self.limits.max_field_size)
+        if self._form is None:
+            parser = LimitedMultiPartParser(self.headers, self.stream(),
+                                            self.limits)
+            try:
+                self._form = await parser.parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+            except BaseException:
+                # e.g. too_large(). Older Starlette versions only close the
+                # files of the parts before on a MultiPartException (closing
+                # them twice is fine)
+                for file in parser._files_to_close_on_error:
+                    file.close()
+                raise
+        return self._form
+
+
+class LimitedFormRoute(APIRoute):
+    limits = FormLimits()
+
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+        limits = self.limits
+
+        async def limited_route_handler(request: Request):
+            request = LimitedFormRequest(request.scope, request.receive,
+                                         limits)
+            return await original_route_handler(request)
+
+        return limited_route_handler
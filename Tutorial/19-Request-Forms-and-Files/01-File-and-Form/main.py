@@ -7,9 +7,14 @@ To receive uploaded files and/or form data, first install python-multipart.
 
 E.g. pip install python-multipart.
 '''
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile
+
+from limits import LimitedFormRoute
+from streaming_form import StreamingForm, get_streaming_form
 
 app = FastAPI()
+# Reject forms that are too big while they are received (see limits.py)
+app.router.route_class = LimitedFormRoute
 
 
 # Create file and form parameters the same way you would for Body or Query
@@ -22,6 +27,29 @@ async def create_file(file: bytes = File(...),
         "token": token,
         "fileb_content_type": fileb.content_type
     }
+
+
+# Check the token before receiving the files (see streaming_form.py)
+async def verify_token(form: StreamingForm = Depends(get_streaming_form)):
+    fields = await form.read_fields()
+    if fields.get("token") != "fake-super-secret-token":
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return fields["token"]
+
+
+@app.post("/streamingfiles/")
+async def create_streaming_files(
+        token: str = Depends(verify_token),
+        form: StreamingForm = Depends(get_streaming_form)):
+    files = await form.read_files()
+    return {
+        "token": token,
+        "files": [
+            {"field": name, "filename": upload.filename,
+             "size": upload.size, "content_type": upload.content_type}
+            for name, upload in files
+        ],
+    }
 '''
 The files and form fields will be uploaded as form data and you will
 receive the files and form fields.
@@ -0,0 +1,135 @@
+'''
+Checking form fields before receiving the files
+
+With token: str = Form(...) and File(...) parameters, the whole form is
+received (all the files too) before the path operation or any of its
+dependencies can look at the token. An upload with a wrong token is only
+refused after transferring all of it.
+
+StreamingForm parses the multipart/form-data body while it is received
+(with iter_multipart() of multipart_stream.py, the same as in
+18-Request-Files), and stops at the first file:
+
+    * read_fields() returns the form fields that come before the first
+      file. A dependency can check them (e.g. the token) and raise an
+      HTTPException, then the rest of the body is never read, only the
+      first few KB were received.
+    * read_files() continues with the files, each one in an UploadFile
+      (in memory up to spool_max_size, then on disk). Fields after the
+      files are added to fields.
+
+Browsers send the fields in the same order as the <input>s of the <form>,
+so put the fields to check before the files. A client that sends the
+files first gets the fields as missing.
+
+The size limits of limits.py apply too, and the fields before the first
+file can't be more than EARLY_FIELDS_MAX_SIZE in total.
+'''
+from tempfile import SpooledTemporaryFile
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request, UploadFile
+from starlette.datastructures import Headers
+
+from limits import FormLimits, too_large
+from multipart_stream import PART_END, PART_START, Part, iter_multipart
+
+EARLY_FIELDS_MAX_SIZE = 8 * 1024
+
+
+class StreamingForm:
+    def __init__(self, request: Request, limits: FormLimits):
+        self.limits = limits
+        self.fields: Dict[str, str] = {}
+        self.files: List[Tuple[str, UploadFile]] = []
+        self._events = iter_multipart(request)
+        # The first file part, read by read_fields() but not used yet
+        self._next_file: Optional[Part] = None
+        self._fields_read = False
+
+    async def _read_field(self, part: Part, max_size: int) -> int:
+        value = bytearray()
+        async for event, data in self._events:
+            if event == PART_END:
+                break
+            value += data
+            if len(value) > max_size:
+                raise too_large(f"Field {part.name!r} is larger than "
+                                f"{max_size} bytes")
+        if len(self.fields) >= self.limits.max_fields:
+            raise too_large(f"More than {self.limits.max_fields} fields")
+        self.fields[part.name] = value.decode("utf-8", "replace")
+        return len(value)
+
+    async def _read_file(self, part: Part) -> UploadFile:
+        if len(self.files) >= self.limits.max_files:
+            raise too_large(f"More than {self.limits.max_files} files")
+        upload = UploadFile(
+            SpooledTemporaryFile(max_size=self.limits.spool_max_size),
+            size=0, filename=part.filename, headers=Headers(
+                raw=[(name, value) for name, value in part.headers]))
+        self.files.append((part.name, upload))
+        async for event, data in self._events:
+            if event == PART_END:
+                break
+            if upload.size + len(data) > self.limits.max_file_size:
+                raise too_large(f"File {part.name!r} is larger than "
+                                f"{self.limits.max_file_size} bytes")
+            # Moves it to disk in a thread when it gets too big
+            await upload.write(data)
+        await upload.seek(0)
+        return upload
+
+    async def read_fields(self) -> Dict[str, str]:
+        '''
+        The form fields before the first file. Only reads the body up to
+        the start of that file.
+        '''
+        if self._fields_read:
+            return self.fields
+        self._fields_read = True
+        early_size = 0
+        async for event, part in self._events:
+            if event != PART_START:
+                continue
+            if part.filename is not None:
+                self._next_file = part
+                break
+            early_size += await self._read_field(
+                part, min(self.limits.max_field_size,
+                          EARLY_FIELDS_MAX_SIZE - early_size))
+        return self.fields
+
+    async def read_files(self) -> List[Tuple[str, UploadFile]]:
+        '''
+        The rest of the body: (field name, UploadFile) for each file.
+        '''
+        await self.read_fields()
+        if self._next_file is not None:
+            part, self._next_file = self._next_file, None
+            await self._read_file(part)
+        async for event, part in self._events:
+            if event != PART_START:
+                continue
+            if part.filename is not None:
+                await self._read_file(part)
+            else:
+                await self._read_field(part, self.limits.max_field_size)
+        return self.files
+
+    async def close(self):
+        await self._events.aclose()
+        for _, upload in self.files:
+            await upload.close()
+
+
+async def get_streaming_form(request: Request):
+    '''
+    Dependency with the StreamingForm of the request, the same one for all
+    the dependencies that use it, closed after the response.
+    '''
+    form = StreamingForm(request, getattr(request, "limits", FormLimits()))
+    try:
+        yield form
+    finally:
+        await form.close()
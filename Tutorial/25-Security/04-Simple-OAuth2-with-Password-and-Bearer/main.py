@@ -1,8 +1,17 @@
 from typing import Optional
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 
+from fast_form import FastFormRoute
+from rate_limit import (LOGIN_LIMIT_PER_IP, LOGIN_LIMIT_PER_USERNAME,
+                        make_rate_limiter)
+from users import CachedUserRepository, SQLiteUserRepository, UserRepository
+
+USERS_DB = "users.db"
+# e.g. "redis://localhost:6379/0" to share the login limits between workers
+RATE_LIMIT_REDIS_URL: Optional[str] = None
+
 fake_users_db = {
     "johndoe": {
         "username": "johndoe",
@@ -21,6 +30,9 @@ fake_users_db = {
 }
 
 app = FastAPI()
+# Small urlencoded forms (/token) skip the streaming parser, see
+# fast_form.py
+app.router.route_class = FastFormRoute
 
 
 def fake_hash_password(password: str):
@@ -41,45 +53,78 @@ class UserInDB(User):
     hashed_password: str
 
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+# The users are saved in SQLite, the ones already read are kept in memory.
+users = CachedUserRepository(SQLiteUserRepository(USERS_DB, UserInDB))
+users.add_many(fake_users_db.values())
+
+
+def get_user(db: UserRepository, username: str):
+    return db.get(username)
 
 
 def fake_decode_token(token):
     # This doesn't provide any security at all
     # Check the next version
-    user = get_user(fake_users_db, token)
+    user = get_user(users, token)
     return user
 
 
+# Built once, not on every request. with_traceback(None) when raising
+# them, so the same object doesn't keep growing its traceback.
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Invalid authentication credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+inactive_user_exception = HTTPException(status_code=400,
+                                        detail="Inactive user")
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     user = fake_decode_token(token)
     if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        raise credentials_exception.with_traceback(None)
     return user
 
 
-async def get_current_active_user(
-    current_user: User = Depends(get_current_user)
-):
-    if current_user.disabled:
-        raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
+async def get_current_active_user(token: str = Depends(oauth2_scheme)):
+    # token -> user -> active check in a single dependency, instead of
+    # depending on get_current_user
+    user = fake_decode_token(token)
+    if not user:
+        raise credentials_exception.with_traceback(None)
+    if user.disabled:
+        raise inactive_user_exception.with_traceback(None)
+    return user
+
 
+# Password attempts allowed per username and per IP in a sliding window.
+username_limiter = make_rate_limiter(LOGIN_LIMIT_PER_USERNAME,
+                                     RATE_LIMIT_REDIS_URL)
+ip_limiter = make_rate_limiter(LOGIN_LIMIT_PER_IP, RATE_LIMIT_REDIS_URL)
 
-@app.post("/token")
+
+async def check_login_rate(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+):
+    client_ip = request.client.host if request.client else "unknown"
+    for limiter, key in ((ip_limiter, f"ip:{client_ip}"),
+                         (username_limiter, f"user:{form_data.username}")):
+        if not await limiter.hit(key):
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": str(limiter.retry_after)},
+            )
+
+
+@app.post("/token", dependencies=[Depends(check_login_rate)])
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user_dict = fake_users_db.get(form_data.username)
-    if not user_dict:
+    user = get_user(users, form_data.username)
+    if not user:
         raise HTTPException(status_code=400,
                             detail="Incorrect username or password")
-    user = UserInDB(**user_dict)
     hashed_password = fake_hash_password(form_data.password)
     if not hashed_password == user.hashed_password:
         raise HTTPException(status_code=400,
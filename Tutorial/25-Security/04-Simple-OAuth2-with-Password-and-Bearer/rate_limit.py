@@ -0,0 +1,146 @@
+'''
+Login rate limiting
+
+Each password attempt costs a password verification, so an attacker could
+try passwords forever, or just keep the server busy. The login attempts
+are counted per username and per client IP, and when there are too many in
+the last window of time, the request is rejected (429) before checking the
+password.
+
+Sliding window
+
+The window (e.g. 60 seconds) is split in a few buckets (e.g. 6 of 10
+seconds). Each key has a ring buffer with the count of each bucket and the
+total. When time moves forward, the buckets that left the window are
+subtracted from the total and reused, so checking a key is a fixed amount
+of work and a fixed amount of memory.
+
+Only the last max_keys keys are remembered, the least recently used are
+dropped, so memory doesn't grow with the number of usernames or IPs.
+
+With several workers, each one has its own counters. RedisRateLimiter keeps
+them in a Redis (or Redis compatible) server shared by all the workers,
+using the same idea with two fixed windows weighted by time. It uses the
+asyncio client of redis-py, so waiting for Redis doesn't block the event
+loop. hit() is async in both, to use them the same way.
+
+04-Simple-OAuth2-with-Password-and-Bearer and 05-OAuth2-with-Password-
+and-hashing-Bearer-with-JWT-tokens have the same copy of this file.
+'''
+import time
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+LOGIN_WINDOW_SECONDS = 60
+LOGIN_WINDOW_BUCKETS = 6
+LOGIN_LIMIT_PER_USERNAME = 5
+LOGIN_LIMIT_PER_IP = 20
+RATE_LIMIT_MAX_KEYS = 100_000
+
+
+class _Window:
+    __slots__ = ("counts", "last_bucket", "total")
+
+    def __init__(self, buckets: int, bucket: int):
+        self.counts = array("I", bytes(4 * buckets))
+        self.last_bucket = bucket
+        self.total = 0
+
+
+class RateLimiter:
+    def __init__(self,
+                 limit: int,
+                 window_seconds: float = LOGIN_WINDOW_SECONDS,
+                 buckets: int = LOGIN_WINDOW_BUCKETS,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.bucket_seconds = window_seconds / buckets
+        self.max_keys = max_keys
+        self._windows: "OrderedDict[str, _Window]" = OrderedDict()
+
+    @property
+    def retry_after(self) -> int:
+        # The oldest bucket leaves the window at most this much later
+        return max(1, round(self.bucket_seconds))
+
+    def _advance(self, window: _Window, bucket: int):
+        passed = bucket - window.last_bucket
+        if passed >= self.buckets:
+            for i in range(self.buckets):
+                window.counts[i] = 0
+            window.total = 0
+        else:
+            for b in range(window.last_bucket + 1, bucket + 1):
+                i = b % self.buckets
+                window.total -= window.counts[i]
+                window.counts[i] = 0
+        window.last_bucket = bucket
+
+    async def hit(self, key: str, now: Optional[float] = None) -> bool:
+        '''
+        Counts one attempt for key, returns False if it is over the limit.
+        '''
+        bucket = int((time.time() if now is None else now)
+                     / self.bucket_seconds)
+        window = self._windows.get(key)
+        if window is None:
+            window = _Window(self.buckets, bucket)
+            self._windows[key] = window
+            if len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(key)
+            if bucket > window.last_bucket:
+                self._advance(window, bucket)
+        if window.total >= self.limit:
+            return False
+        window.counts[bucket % self.buckets] += 1
+        window.total += 1
+        return True
+
+
+class RedisRateLimiter:
+    def __init__(self,
+                 url: str,
+                 limit: int,
+                 window_seconds: float = LOGIN_WINDOW_SECONDS,
+                 prefix: str = "login"):
+        if redis is None:
+            raise RuntimeError("RedisRateLimiter needs: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.prefix = prefix
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, round(self.window_seconds))
+
+    async def hit(self, key: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        current = int(now // self.window_seconds)
+        elapsed = now / self.window_seconds - current
+        current_key = f"{self.prefix}:{key}:{current}"
+        previous_key = f"{self.prefix}:{key}:{current - 1}"
+        async with self.client.pipeline() as pipe:
+            pipe.incr(current_key)
+            pipe.expire(current_key, int(self.window_seconds * 2))
+            pipe.get(previous_key)
+            count, _, previous = await pipe.execute()
+        # The previous window counts less the further we are in this one
+        estimate = int(previous or 0) * (1 - elapsed) + count - 1
+        return estimate < self.limit
+
+
+def make_rate_limiter(limit: int, redis_url: Optional[str] = None):
+    if redis_url:
+        return RedisRateLimiter(redis_url, limit)
+    return RateLimiter(limit)
@@ -0,0 +1,66 @@
+'''
+Login throughput benchmark
+
+Sends concurrent requests to /token and reports logins per second for a
+growing number of hashing workers (1, 2, 4, ... up to the number of cores).
+
+Run it with:
+
+$ python bench_login.py [logins] [thread|process]
+
+The requests go straight to the ASGI app with httpx, no server is needed.
+'''
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+import main
+from hashing import HashingExecutor
+from rate_limit import RateLimiter
+
+
+async def run_logins(count: int) -> float:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        form = {"username": "johndoe", "password": "secret"}
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *[client.post("/token", data=form) for _ in range(count)]
+        )
+        elapsed = time.perf_counter() - start
+    assert all(r.status_code == 200 for r in responses)
+    return elapsed
+
+
+def worker_counts():
+    cores = os.cpu_count() or 1
+    count = 1
+    while count < cores:
+        yield count
+        count *= 2
+    yield cores
+
+
+def main_bench():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    # Without login limits, all the logins come from the same user and IP
+    main.username_limiter = RateLimiter(10 ** 9)
+    main.ip_limiter = RateLimiter(10 ** 9)
+    kind = sys.argv[2] if len(sys.argv) > 2 else "thread"
+    print(f"{logins} concurrent logins, {kind} pool")
+    print(f"{'workers':>8} {'seconds':>8} {'logins/s':>9}")
+    for workers in worker_counts():
+        main.hasher = HashingExecutor(kind=kind,
+                                      workers=workers,
+                                      max_pending=logins)
+        elapsed = asyncio.run(run_logins(logins))
+        main.hasher.shutdown()
+        print(f"{workers:>8} {elapsed:>8.2f} {logins / elapsed:>9.1f}")
+
+
+if __name__ == "__main__":
+    main_bench()
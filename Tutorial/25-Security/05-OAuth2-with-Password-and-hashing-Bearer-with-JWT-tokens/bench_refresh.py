@@ -0,0 +1,61 @@
+'''
+Refresh token CPU benchmark
+
+Measures the CPU time of renewing a session with the password
+(grant_type=password, a full bcrypt verification) and with a refresh
+token (grant_type=refresh_token), and what that means per active user
+per hour, with a new access token every ACCESS_TOKEN_EXPIRE_MINUTES.
+
+Run it with:
+
+$ python bench_refresh.py [renewals]
+'''
+import asyncio
+import sys
+import time
+
+import httpx
+
+import main
+from rate_limit import RateLimiter
+
+
+async def cpu_per_renewal(count: int, grant_type: str) -> float:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        form = {"username": "johndoe", "password": "secret"}
+        response = await client.post("/token", data=form)
+        refresh_token = response.json()["refresh_token"]
+        # process_time also counts the hashing threads
+        start = time.process_time()
+        for _ in range(count):
+            if grant_type == "refresh_token":
+                form = {"grant_type": "refresh_token",
+                        "refresh_token": refresh_token}
+            response = await client.post("/token", data=form)
+            assert response.status_code == 200
+            refresh_token = response.json()["refresh_token"]
+        return (time.process_time() - start) / count
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    # Without login limits, all the logins come from the same user and IP
+    main.username_limiter = RateLimiter(10 ** 9)
+    main.ip_limiter = RateLimiter(10 ** 9)
+    renewals_per_hour = 60 / main.ACCESS_TOKEN_EXPIRE_MINUTES
+    print(f"{renewals_per_hour:g} renewals per active user per hour")
+    results = {}
+    for grant_type in ("password", "refresh_token"):
+        cpu = asyncio.run(cpu_per_renewal(count, grant_type))
+        results[grant_type] = cpu
+        print(f"{grant_type:>14}: {cpu * 1e3:8.2f} ms CPU per renewal, "
+              f"{cpu * renewals_per_hour * 1e3:8.2f} ms per user per hour")
+    main.hasher.shutdown()
+    saved = 1 - results["refresh_token"] / results["password"]
+    print(f"CPU saved per user per hour: {saved:.1%}")
+
+
+if __name__ == "__main__":
+    main_bench()
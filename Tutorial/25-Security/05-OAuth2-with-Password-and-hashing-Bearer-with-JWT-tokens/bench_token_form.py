@@ -0,0 +1,100 @@
+'''
+/token form benchmark
+
+Microseconds per request for the form of /token
+(grant_type=password&username=johndoe&password=secret&scope=me), with the
+normal route and with FastFormRoute (fast_form.py).
+
+Checking the password takes much longer than the form, so here the path
+operation only takes the same OAuth2TokenRequestForm as /token and
+returns it, to see the cost of the form alone.
+
+The app is called directly with ASGI messages, no server or HTTP client.
+Each one runs ROUNDS times, taking turns, and the best round is shown.
+
+Run it with:
+
+$ python bench_token_form.py [requests]
+'''
+import asyncio
+import sys
+import time
+
+from fastapi import Depends, FastAPI
+from fastapi.routing import APIRoute
+
+from fast_form import FastFormRoute
+from main import OAuth2TokenRequestForm
+
+ROUNDS = 5
+BODY = b"grant_type=password&username=johndoe&password=secret&scope=me"
+
+SCOPE = {
+    "type": "http",
+    "asgi": {"version": "3.0"},
+    "http_version": "1.1",
+    "method": "POST",
+    "scheme": "http",
+    "path": "/token",
+    "raw_path": b"/token",
+    "root_path": "",
+    "query_string": b"",
+    "headers": [
+        (b"host", b"test"),
+        (b"content-type", b"application/x-www-form-urlencoded"),
+        (b"content-length", str(len(BODY)).encode()),
+    ],
+    "client": ("127.0.0.1", 12345),
+    "server": ("test", 80),
+}
+
+
+def token_app(route_class) -> FastAPI:
+    app = FastAPI()
+    app.router.route_class = route_class
+
+    @app.post("/token")
+    async def login(form_data: OAuth2TokenRequestForm = Depends()):
+        return {"grant_type": form_data.grant_type,
+                "username": form_data.username,
+                "scopes": form_data.scopes}
+
+    return app
+
+
+async def run_requests(app, count: int) -> float:
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": BODY, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    # Warm up
+    for _ in range(100):
+        await app(dict(SCOPE), receive, send)
+    assert status == 200
+    start = time.perf_counter()
+    for _ in range(count):
+        await app(dict(SCOPE), receive, send)
+    return time.perf_counter() - start
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    apps = {"default": token_app(APIRoute), "fast": token_app(FastFormRoute)}
+    best = {label: float("inf") for label in apps}
+    for _ in range(ROUNDS):
+        for label, app in apps.items():
+            elapsed = asyncio.run(run_requests(app, count))
+            best[label] = min(best[label], elapsed)
+    print(f"{count} requests to /token, best of {ROUNDS}")
+    for label, elapsed in best.items():
+        print(f"{label:>9}: {elapsed / count * 1e6:7.1f} us/request")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,73 @@
+'''
+User repository benchmark
+
+Fills a SQLite user repository with many users (1 million by default) and
+measures random lookups by username and by email, with and without the
+cache of validated UserInDB objects. A dict with UserInDB(**user_dict),
+like fake_users_db, is measured too for comparison.
+
+Run it with:
+
+$ python bench_users.py [users] [lookups]
+'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+from main import UserInDB
+from users import (CachedUserRepository, InMemoryUserRepository,
+                   SQLiteUserRepository)
+
+HASHED_PASSWORD = "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW"
+
+
+def fake_users(count: int):
+    for i in range(count):
+        yield {
+            "username": f"user{i}",
+            "email": f"user{i}@example.com",
+            "full_name": f"User {i}",
+            "hashed_password": HASHED_PASSWORD,
+            "disabled": False,
+        }
+
+
+def measure(label: str, lookup, keys):
+    start = time.perf_counter()
+    for key in keys:
+        assert lookup(key) is not None
+    elapsed = time.perf_counter() - start
+    print(f"{label:>28}: {elapsed / len(keys) * 1e6:8.2f} us/lookup")
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    # Hot clients: most lookups go to a small set of users
+    hot = [f"user{random.randrange(count)}" for _ in range(1000)]
+    usernames = [random.choice(hot) for _ in range(lookups)]
+    emails = [f"{username}@example.com" for username in usernames]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "users.db")
+        sqlite_users = SQLiteUserRepository(path, UserInDB)
+        start = time.perf_counter()
+        sqlite_users.add_many(fake_users(count))
+        print(f"inserted {count} users in "
+              f"{time.perf_counter() - start:.1f} s")
+
+        memory_users = InMemoryUserRepository({}, UserInDB)
+        memory_users.add_many(fake_users(count))
+        cached_users = CachedUserRepository(sqlite_users)
+
+        measure("dict + UserInDB", memory_users.get, usernames)
+        measure("sqlite by username", sqlite_users.get, usernames)
+        measure("sqlite by email", sqlite_users.get_by_email, emails)
+        measure("cached sqlite by username", cached_users.get, usernames)
+        sqlite_users.close()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,49 @@
+'''
+/users/me/ benchmark
+
+Compares GET /users/me/ with the token cache turned off (every request
+decodes the JWT and builds a new UserInDB) and turned on.
+
+Run it with:
+
+$ python bench_users_me.py [requests]
+'''
+import asyncio
+import sys
+import time
+from datetime import timedelta
+
+import httpx
+
+import main
+from token_cache import TokenCache
+
+
+async def run_requests(count: int) -> float:
+    token = main.create_access_token(
+        data={"sub": "johndoe", "scope_bits": main.scopes_to_bits(["me"])},
+        expires_delta=timedelta(minutes=30),
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://test") as client:
+        start = time.perf_counter()
+        for _ in range(count):
+            response = await client.get("/users/me/", headers=headers)
+            assert response.status_code == 200
+        return time.perf_counter() - start
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{count} requests to /users/me/")
+    for label, cache in (("no cache", TokenCache(max_size=0)),
+                         ("cache", TokenCache())):
+        main.token_cache = cache
+        elapsed = asyncio.run(run_requests(count))
+        print(f"{label:>10}: {elapsed / count * 1e6:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    main_bench()
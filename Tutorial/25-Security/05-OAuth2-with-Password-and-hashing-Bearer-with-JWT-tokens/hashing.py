@@ -0,0 +1,193 @@
+'''
+Password hashing executor
+
+Bcrypt is slow on purpose, a single verification takes a few hundred
+milliseconds. If we call pwd_context.verify() directly from an async path
+operation, the event loop is blocked for all that time and every other
+request on the worker has to wait.
+
+So, instead, the hashing work is sent to a pool of workers:
+
+    * "thread": a ThreadPoolExecutor. Bcrypt releases the GIL while it is
+      hashing, so threads already use several cores.
+    * "process": a ProcessPoolExecutor, for hashing schemes that don't
+      release the GIL.
+
+The pool has a limit on how many jobs can be waiting. When the limit is
+reached HashingBusy is raised right away, and the application answers with
+a 503 instead of piling up more work that it can't finish in time.
+
+Bcrypt cost
+
+The bcrypt "rounds" is a cost factor, each extra round doubles the time.
+Instead of hardcoding it, calibrate_rounds() measures this machine at
+startup and picks the rounds that take about BCRYPT_TARGET_SECONDS
+(never less than BCRYPT_MIN_ROUNDS). It times BCRYPT_CALIBRATION_SAMPLES
+hashes and uses the median, so one slow hash (the first one, or another
+process taking the CPU) doesn't change the result.
+
+The measure changes a bit each time, so it is only done once: the rounds
+are saved in BCRYPT_ROUNDS_FILE, and the next starts (and the other
+workers) use the same ones. Delete the file to measure again, e.g. on new
+hardware.
+
+Hashes made with a cost more than BCRYPT_ROUNDS_TOLERANCE rounds below
+it, or with another scheme, are reported by needs_update(), so they can
+be hashed again on next login. A hash with a higher cost is kept: hashing
+it again would make it weaker, e.g. after a calibration on a slower
+machine.
+'''
+import asyncio
+import math
+import os
+import statistics
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from passlib.context import CryptContext
+from passlib.hash import bcrypt
+
+HASHING_EXECUTOR = "thread"  # "thread" or "process"
+HASHING_WORKERS = os.cpu_count() or 1
+HASHING_MAX_PENDING = HASHING_WORKERS * 4
+HASHING_RETRY_AFTER = 1  # seconds, sent back in the 503 response
+
+BCRYPT_TARGET_SECONDS = 0.25
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+BCRYPT_ROUNDS_TOLERANCE = 1
+BCRYPT_CALIBRATION_SAMPLES = 5
+BCRYPT_ROUNDS_FILE = "bcrypt_rounds"
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def calibrate_rounds(target_seconds: float = BCRYPT_TARGET_SECONDS,
+                     samples: int = BCRYPT_CALIBRATION_SAMPLES) -> int:
+    handler = bcrypt.using(rounds=BCRYPT_MIN_ROUNDS)
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash("calibration")
+        times.append(time.perf_counter() - start)
+    elapsed = statistics.median(times)
+    # Each round doubles the time
+    extra = math.floor(math.log2(target_seconds / elapsed))
+    return max(BCRYPT_MIN_ROUNDS, min(BCRYPT_MAX_ROUNDS,
+                                      BCRYPT_MIN_ROUNDS + extra))
+
+
+def load_or_calibrate_rounds(path: str,
+                             target_seconds: float = BCRYPT_TARGET_SECONDS
+                             ) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        pass
+    rounds = calibrate_rounds(target_seconds)
+    try:
+        # Only the first worker to finish saves it, the others use that one
+        with open(path, "x") as f:
+            f.write(f"{rounds}\n")
+    except FileExistsError:
+        with open(path) as f:
+            return int(f.read())
+    return rounds
+
+
+def set_rounds(rounds: int):
+    pwd_context.update(bcrypt__rounds=rounds)
+
+
+class HashingBusy(Exception):
+    def __init__(self, retry_after: int = HASHING_RETRY_AFTER):
+        self.retry_after = retry_after
+
+
+# These run inside the workers, they have to be module level functions
+# so a process pool can pickle them.
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+class HashingExecutor:
+    def __init__(self,
+                 kind: str = HASHING_EXECUTOR,
+                 workers: int = HASHING_WORKERS,
+                 max_pending: int = HASHING_MAX_PENDING):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hashing executor: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rounds: Optional[int] = None
+        self._pool: Optional[Executor] = None
+
+    def _get_pool(self) -> Executor:
+        # Created on first use, so importing the module doesn't
+        # start any threads or processes.
+        if self._pool is None:
+            if self.kind == "process":
+                # Each process has its own pwd_context
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=set_rounds if self.rounds else None,
+                    initargs=(self.rounds,) if self.rounds else (),
+                )
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="hashing",
+                )
+        return self._pool
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise HashingBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_pool(), func, *args)
+        finally:
+            self.pending -= 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(_verify, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self.run(_hash, password)
+
+    def needs_update(self, hashed_password: str) -> bool:
+        if self.rounds is not None and bcrypt.identify(hashed_password):
+            rounds = bcrypt.from_string(hashed_password).rounds
+            # Only upgraded, never to a lower cost
+            return rounds < self.rounds - BCRYPT_ROUNDS_TOLERANCE
+        return pwd_context.needs_update(hashed_password)
+
+    async def calibrate(self,
+                        target_seconds: float = BCRYPT_TARGET_SECONDS,
+                        path: str = BCRYPT_ROUNDS_FILE) -> int:
+        loop = asyncio.get_running_loop()
+        rounds = await loop.run_in_executor(None, load_or_calibrate_rounds,
+                                            path, target_seconds)
+        self.set_rounds(rounds)
+        return rounds
+
+    def set_rounds(self, rounds: int):
+        self.rounds = rounds
+        set_rounds(rounds)
+        if self.kind == "process":
+            # Started again on next use, with the new rounds
+            self.shutdown()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -0,0 +1,216 @@
+'''
+Asymmetric signing keys
+
+With HS256 the same SECRET_KEY is used to sign and to verify the tokens,
+so every service that wants to verify a token needs the secret, and could
+also create tokens.
+
+With an asymmetric algorithm, tokens are signed with a private key and
+verified with the public key. The public keys are published at
+/.well-known/jwks.json (a "JWK Set"), so other services can verify tokens
+offline, without any secret.
+
+    * Each key has a "kid" (key id), written in the header of the tokens
+      it signs, so the verifier knows which public key to use.
+    * A new key is created every KEY_ROTATION_DAYS. The previous keys are
+      still published until the last token they signed has expired.
+    * The keys are parsed once, when they are loaded or created, so
+      verifying a token never parses a PEM again.
+
+With several workers (processes) they all share the keys directory. Only
+one of them rotates at a time (a lock file, KEY_LOCK_FILE). When a token
+comes with an unknown "kid", the key is read from the directory, if
+another worker made it. And rotate_if_due() reads all the changes.
+
+python-jose (with the cryptography backend) supports RS256 and ES256.
+'''
+import os
+import re
+import secrets
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import jwk, jwt
+from jose.backends.base import Key
+from jose.exceptions import JWTError
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, only one worker can rotate safely there
+    fcntl = None
+
+KEYS_DIR = "jwt_keys"
+KEY_ROTATION_DAYS = 30
+KEY_LOCK_FILE = ".lock"
+
+# "<created at>-<random>", see rotate()
+_kid = re.compile(r"^[0-9]+-[0-9a-f]{8}$")
+
+
+@dataclass
+class SigningKey:
+    kid: str
+    algorithm: str
+    created_at: float
+    private_key: Key
+    public_key: Key
+
+
+def generate_private_pem(algorithm: str) -> bytes:
+    if algorithm == "RS256":
+        private_key = rsa.generate_private_key(public_exponent=65537,
+                                               key_size=2048)
+    elif algorithm == "ES256":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Unsupported signing algorithm: {algorithm}")
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+class KeyRing:
+    def __init__(self,
+                 algorithm: str = "RS256",
+                 keys_dir: str = KEYS_DIR,
+                 rotation: timedelta = timedelta(days=KEY_ROTATION_DAYS),
+                 max_token_age: timedelta = timedelta(minutes=30)):
+        self.algorithm = algorithm
+        self.keys_dir = keys_dir
+        self.rotation = rotation.total_seconds()
+        self.max_token_age = max_token_age.total_seconds()
+        self.keys: Dict[str, SigningKey] = {}
+        self.current: Optional[SigningKey] = None
+        self._jwks: dict = {"keys": []}
+        os.makedirs(self.keys_dir, exist_ok=True)
+        self.rotate_if_due()
+
+    def _add(self, kid: str, pem: bytes, created_at: float):
+        private_key = jwk.construct(pem, self.algorithm)
+        self.keys[kid] = SigningKey(
+            kid=kid,
+            algorithm=self.algorithm,
+            created_at=created_at,
+            private_key=private_key,
+            public_key=private_key.public_key(),
+        )
+
+    def reload(self):
+        '''
+        Reads the keys created, and forgets the ones removed, by other
+        workers.
+        '''
+        kids = set()
+        for filename in os.listdir(self.keys_dir):
+            kid, extension = os.path.splitext(filename)
+            if extension != ".pem":
+                continue
+            kids.add(kid)
+            if kid in self.keys:
+                continue
+            path = os.path.join(self.keys_dir, filename)
+            try:
+                with open(path, "rb") as f:
+                    self._add(kid, f.read(), os.path.getmtime(path))
+            except FileNotFoundError:
+                # Removed by another worker meanwhile
+                kids.discard(kid)
+        for kid in set(self.keys) - kids:
+            del self.keys[kid]
+        self._refresh()
+
+    def _load_key(self, kid: str) -> Optional[SigningKey]:
+        # Maybe a new key of another worker, only a stat() if it isn't
+        path = os.path.join(self.keys_dir, f"{kid}.pem")
+        try:
+            with open(path, "rb") as f:
+                self._add(kid, f.read(), os.path.getmtime(path))
+        except FileNotFoundError:
+            return None
+        self._refresh()
+        return self.keys[kid]
+
+    @contextmanager
+    def _rotation_lock(self):
+        with open(os.path.join(self.keys_dir, KEY_LOCK_FILE), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        by_age: List[SigningKey] = sorted(self.keys.values(),
+                                          key=lambda key: key.created_at)
+        self.current = by_age[-1] if by_age else None
+        keys = []
+        for key in by_age:
+            public_jwk = key.public_key.to_dict()
+            public_jwk.update({"kid": key.kid, "use": "sig"})
+            keys.append(public_jwk)
+        self._jwks = {"keys": keys}
+
+    def rotate(self) -> SigningKey:
+        kid = f"{int(time.time())}-{secrets.token_hex(4)}"
+        pem = generate_private_pem(self.algorithm)
+        path = os.path.join(self.keys_dir, f"{kid}.pem")
+        temp_path = path + ".tmp"
+        # The private key file is only readable by us
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pem)
+        # Other workers never see a half written .pem
+        os.rename(temp_path, path)
+        self._add(kid, pem, os.path.getmtime(path))
+        self._refresh()
+        return self.current
+
+    def rotate_if_due(self):
+        with self._rotation_lock():
+            # Another worker may have rotated already
+            self.reload()
+            now = time.time()
+            if self.current is None or \
+                    now - self.current.created_at >= self.rotation:
+                self.rotate()
+            # A key stops signing when the next one is created, the tokens
+            # it signed are still valid for max_token_age after that.
+            by_age = sorted(self.keys.values(),
+                            key=lambda key: key.created_at)
+            for key, next_key in zip(by_age, by_age[1:]):
+                if next_key.created_at + self.max_token_age <= now:
+                    del self.keys[key.kid]
+                    try:
+                        os.remove(os.path.join(self.keys_dir,
+                                               f"{key.kid}.pem"))
+                    except FileNotFoundError:
+                        pass
+            self._refresh()
+
+    def jwks(self) -> dict:
+        return self._jwks
+
+    def encode(self, claims: dict) -> str:
+        key = self.current
+        return jwt.encode(claims, key.private_key,
+                          algorithm=key.algorithm,
+                          headers={"kid": key.kid})
+
+    def decode(self, token: str) -> dict:
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.keys.get(kid)
+        if key is None and isinstance(kid, str) and _kid.match(kid):
+            key = self._load_key(kid)
+        if key is None:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, key.public_key, algorithms=[key.algorithm])
@@ -1,17 +1,40 @@
+import asyncio
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
+from uuid import uuid4
 
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi import (BackgroundTasks, Depends, FastAPI, Form, HTTPException,
+                     Request, Security, status)
+from fastapi.responses import JSONResponse, Response
+from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from hashing import HashingBusy, HashingExecutor
+from keys import KeyRing
+from fast_form import FastFormRoute
+from rate_limit import (LOGIN_LIMIT_PER_IP, LOGIN_LIMIT_PER_USERNAME,
+                        make_rate_limiter)
+from refresh_tokens import RefreshTokenReused, RefreshTokenStore
+from revocation import (REVOCATION_PRUNE_SECONDS, REVOCATION_REFRESH_SECONDS,
+                        RevocationList)
+from scopes import (SCOPES, bits_to_scopes, required_bits, required_scopes,
+                    scopes_to_bits)
+from token_cache import TokenCache
+from users import CachedUserRepository, SQLiteUserRepository, UserRepository
 
 # to get a string like this run:
 # openssl rand -hex 32
 SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
-ALGORITHM = "HS256"
+# "RS256" or "ES256", the keys are in keys.py
+ALGORITHM = "RS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+USERS_DB = "users.db"
+# e.g. "redis://localhost:6379/0" to share the login limits between workers
+RATE_LIMIT_REDIS_URL: Optional[str] = None
+JWKS_MAX_AGE = 3600
 
 
 fake_users_db = {
@@ -22,6 +45,8 @@ fake_users_db = {
         "hashed_password":
             "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW",
         "disabled": False,
+        # The scopes this user can be granted
+        "scopes": "me items",
     }
 }
 
@@ -29,10 +54,7 @@ fake_users_db = {
 class Token(BaseModel):
     access_token: str
     token_type: str
-
-
-class TokenData(BaseModel):
-    username: Optional[str] = None
+    refresh_token: Optional[str] = None
 
 
 class User(BaseModel):
@@ -44,104 +66,367 @@ class User(BaseModel):
 
 class UserInDB(User):
     hashed_password: str
+    scopes: str = ""
+
+
+# The users are saved in SQLite, the ones already read are kept in memory.
+users = CachedUserRepository(SQLiteUserRepository(USERS_DB, UserInDB))
+users.add_many(fake_users_db.values())
+
+# Password attempts allowed per username and per IP in a sliding window.
+username_limiter = make_rate_limiter(LOGIN_LIMIT_PER_USERNAME,
+                                     RATE_LIMIT_REDIS_URL)
+ip_limiter = make_rate_limiter(LOGIN_LIMIT_PER_IP, RATE_LIMIT_REDIS_URL)
+
+# Access tokens are signed with the current private key of the ring.
+key_ring = KeyRing(
+    algorithm=ALGORITHM,
+    max_token_age=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+)
+
+# Bcrypt runs in a worker pool (see hashing.py), never on the event loop.
+hasher = HashingExecutor()
 
+# Users already validated from a token, until that token expires.
+token_cache = TokenCache()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# "jti" of the tokens revoked before their expiration (logout).
+revoked_tokens = RevocationList()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Sessions are renewed with a refresh token instead of the password, in
+# the same database as the revoked tokens.
+refresh_tokens = RefreshTokenStore(SECRET_KEY)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", scopes=SCOPES)
 
 app = FastAPI()
+# Small urlencoded forms (/token) skip the streaming parser, see
+# fast_form.py
+app.router.route_class = FastFormRoute
+
+
+async def prune_expired_tokens():
+    while True:
+        await asyncio.sleep(REVOCATION_PRUNE_SECONDS)
+        await run_in_threadpool(revoked_tokens.prune)
+        await run_in_threadpool(refresh_tokens.prune)
+        key_ring.rotate_if_due()
+
+
+async def refresh_revoked_tokens():
+    # The tokens revoked by the other workers
+    while True:
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+        await run_in_threadpool(revoked_tokens.refresh)
+
+
+@app.on_event("startup")
+async def calibrate_hasher():
+    # Bcrypt rounds that take about BCRYPT_TARGET_SECONDS on this machine,
+    # measured on the first start and saved in BCRYPT_ROUNDS_FILE
+    await hasher.calibrate()
+
+
+@app.on_event("startup")
+async def start_pruning():
+    app.state.prune_task = asyncio.create_task(prune_expired_tokens())
+    app.state.revocation_task = asyncio.create_task(refresh_revoked_tokens())
+
+
+@app.on_event("shutdown")
+def shutdown_hasher():
+    hasher.shutdown()
+
+
+@app.on_event("shutdown")
+def stop_pruning():
+    app.state.prune_task.cancel()
+    app.state.revocation_task.cancel()
+    revoked_tokens.close()
+    refresh_tokens.close()
+
+
+@app.exception_handler(HashingBusy)
+async def hashing_busy_handler(request: Request, exc: HashingBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many login attempts in progress, "
+                           "try again later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+async def verify_password(plain_password, hashed_password):
+    return await hasher.verify(plain_password, hashed_password)
+
+
+async def get_password_hash(password):
+    return await hasher.hash(password)
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def get_user(db: UserRepository, username: str):
+    return db.get(username)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def disable_user(db: UserRepository, username: str):
+    db.update(username, disabled=True)
+    # Cached users would still say disabled=False
+    token_cache.invalidate_user(username)
+    refresh_tokens.revoke_user(username)
 
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+async def rehash_password(db: UserRepository, username: str, password: str):
+    try:
+        hashed_password = await get_password_hash(password)
+    except HashingBusy:
+        # It will be done on a later login
+        return
+    db.update(username, hashed_password=hashed_password)
 
 
-def authenticate_user(fake_db, username: str, password: str):
-    user = get_user(fake_db, username)
+async def authenticate_user(db: UserRepository, username: str, password: str,
+                            background_tasks: Optional[BackgroundTasks] = None):
+    user = get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
+    if background_tasks is not None and \
+            hasher.needs_update(user.hashed_password):
+        # Hashed with an old scheme or cost, save a new hash
+        # after the response is sent
+        background_tasks.add_task(rehash_password,
+                                  db, user.username, password)
     return user
 
 
+def allowed_scope_bits(user: UserInDB) -> int:
+    return scopes_to_bits(user.scopes.split())
+
+
+async def rotate_refresh_token(refresh_token: str):
+    invalid_grant = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Invalid refresh token",
+    )
+    try:
+        rotated = await run_in_threadpool(refresh_tokens.rotate,
+                                          refresh_token)
+    except RefreshTokenReused:
+        # The whole session was revoked, the client has to log in again
+        raise invalid_grant
+    if rotated is None:
+        raise invalid_grant
+    username, scope_bits, new_refresh_token, family = rotated
+    user = get_user(users, username)
+    if user is None or user.disabled:
+        await run_in_threadpool(refresh_tokens.revoke_user, username)
+        raise invalid_grant
+    # Scopes taken away from the user since the login are not renewed
+    scope_bits &= allowed_scope_bits(user)
+    return user, scope_bits, new_refresh_token, family
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "jti": uuid4().hex})
+    encoded_jwt = key_ring.encode(to_encode)
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
+# Built once, not on every request. with_traceback(None) when raising
+# them, so the same object doesn't keep growing its traceback.
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+inactive_user_exception = HTTPException(status_code=400,
+                                        detail="Inactive user")
+
+
+@lru_cache(maxsize=None)
+def scopes_exception(scope_str: str):
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
+        detail="Not enough permissions",
+        headers={"WWW-Authenticate": f'Bearer scope="{scope_str}"'},
     )
+
+
+async def user_from_token(token: str):
+    '''
+    Returns the user and the scope bits granted to the token.
+    '''
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, scope_bits, jti = cached
+        # Revoked after it was cached, maybe in another worker
+        if await revoked_tokens.is_revoked(jti):
+            token_cache.invalidate_token(token)
+            raise credentials_exception.with_traceback(None)
+        return user, scope_bits
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+        payload = key_ring.decode(token)
     except JWTError:
-        raise credentials_exception
-    user = get_user(fake_users_db, username=token_data.username)
+        raise credentials_exception.with_traceback(None) from None
+    username: str = payload.get("sub")
+    jti = payload.get("jti")
+    if username is None or jti is None or \
+            await revoked_tokens.is_revoked(jti):
+        raise credentials_exception.with_traceback(None)
+    user = get_user(users, username=username)
     if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_exception.with_traceback(None)
+    scope_bits = payload.get("scope_bits", 0)
+    token_cache.set(token, user, payload["exp"], scope_bits, jti)
+    return user, scope_bits
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    return (await user_from_token(token))[0]
 
 
 async def get_current_active_user(
-    current_user: User = Depends(get_current_user)
+    security_scopes: SecurityScopes,
+    token: str = Depends(oauth2_scheme),
 ):
-    if current_user.disabled:
-        raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
+    # token -> user -> scopes -> active check in a single dependency,
+    # instead of depending on get_current_user
+    user, scope_bits = await user_from_token(token)
+    required = required_bits(security_scopes.scope_str)
+    if scope_bits & required != required:
+        raise scopes_exception(security_scopes.scope_str) \
+            .with_traceback(None)
+    if user.disabled:
+        raise inactive_user_exception.with_traceback(None)
+    return user
 
 
-@app.post("/token", response_model=Token)
+class OAuth2TokenRequestForm:
+    '''
+    The same as OAuth2PasswordRequestForm, but it also accepts
+    grant_type=refresh_token with a refresh_token field.
+    '''
+    def __init__(
+        self,
+        grant_type: str = Form("password"),
+        username: Optional[str] = Form(None),
+        password: Optional[str] = Form(None),
+        refresh_token: Optional[str] = Form(None),
+        scope: str = Form(""),
+    ):
+        self.grant_type = grant_type
+        self.username = username
+        self.password = password
+        self.refresh_token = refresh_token
+        self.scopes = scope.split()
+
+
+async def check_login_rate(
+    request: Request,
+    form_data: OAuth2TokenRequestForm = Depends(),
+):
+    # Runs before the password is checked, refresh tokens are cheap
+    if form_data.grant_type != "password":
+        return
+    client_ip = request.client.host if request.client else "unknown"
+    for limiter, key in ((ip_limiter, f"ip:{client_ip}"),
+                         (username_limiter, f"user:{form_data.username}")):
+        if not await limiter.hit(key):
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": str(limiter.retry_after)},
+            )
+
+
+@app.post("/token", response_model=Token,
+          dependencies=[Depends(check_login_rate)])
 async def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends()
+    background_tasks: BackgroundTasks,
+    form_data: OAuth2TokenRequestForm = Depends(),
 ):
-    user = authenticate_user(fake_users_db,
-                             form_data.username,
-                             form_data.password)
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
+    if form_data.grant_type == "refresh_token" and form_data.refresh_token:
+        user, scope_bits, refresh_token, family = await rotate_refresh_token(
+            form_data.refresh_token
         )
+    elif form_data.grant_type == "password" and form_data.username:
+        user = await authenticate_user(users,
+                                       form_data.username,
+                                       form_data.password or "",
+                                       background_tasks)
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect username or password",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        # The scopes are compiled to bits once, here. Only the ones the
+        # user is allowed, all of them if the client didn't ask for any.
+        scope_bits = allowed_scope_bits(user)
+        if form_data.scopes:
+            scope_bits &= scopes_to_bits(form_data.scopes)
+        refresh_token, family = await run_in_threadpool(
+            refresh_tokens.issue, user.username, scope_bits)
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Unsupported grant type")
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={
+            "sub": user.username,
+            "scope": " ".join(bits_to_scopes(scope_bits)),
+            "scope_bits": scope_bits,
+            # The login (refresh token family) the token belongs to
+            "sid": family,
+        },
+        expires_delta=access_token_expires,
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+@app.get("/.well-known/jwks.json")
+async def read_jwks(response: Response):
+    # Other services can cache the public keys and verify tokens offline
+    response.headers["Cache-Control"] = f"public, max-age={JWKS_MAX_AGE}"
+    return key_ring.jwks()
+
+
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(token: str = Depends(oauth2_scheme),
+                 current_user: User = Depends(get_current_user)):
+    # get_current_user already verified the signature
+    payload = jwt.get_unverified_claims(token)
+    await run_in_threadpool(revoked_tokens.revoke, payload["jti"],
+                            payload["exp"])
+    token_cache.invalidate_token(token)
+    # And the refresh tokens of the same login, or they would give new
+    # access tokens
+    if "sid" in payload:
+        await run_in_threadpool(refresh_tokens.revoke_family,
+                                payload["sid"])
 
 
 @app.get("/users/me/", response_model=User)
-async def read_users_me(current_user: User = Depends(get_current_active_user)):
+async def read_users_me(
+    current_user: User = Security(get_current_active_user,
+                                  scopes=required_scopes("me"))
+):
     return current_user
 
 
 @app.get("/users/me/items/")
 async def read_own_items(
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Security(get_current_active_user,
+                                  scopes=required_scopes("items"))
 ):
     return [{"item_id": "Foo", "owner": current_user.username}]
@@ -0,0 +1,155 @@
+'''
+Refresh tokens
+
+Access tokens expire after ACCESS_TOKEN_EXPIRE_MINUTES. Without refresh
+tokens the client has to send the password again, and we have to run a
+full bcrypt verification each time.
+
+Instead, /token also returns a refresh token: a random string that can be
+exchanged (with grant_type=refresh_token) for a new access token. Checking
+it is just an HMAC and a lookup by primary key.
+
+    * Only the HMAC of the refresh token is stored, never the token itself.
+    * Rotation: each refresh token can be used once, using it returns a new
+      refresh token of the same "family" (the same login).
+    * Reuse detection: if a refresh token that was already used comes back,
+      someone else has a copy of it, so the whole family is revoked.
+    * The family is also in the access tokens (the "sid" claim), so
+      /logout can revoke the refresh tokens of that login.
+
+The tokens are in the SQLite database of the revoked tokens (see
+revocation.py), so all the workers see the same ones, and they are still
+valid after a restart. There is one row per family: a token is
+"<family>.<random part>", and the row has the HMAC of the last token
+issued. A token of a known family with another HMAC is an old one, used
+already, so the used tokens don't need to be kept at all. The rows are
+indexed by user too, revoke_user() doesn't go through all of them.
+
+All the methods are blocking, call them in a thread.
+'''
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+from revocation import REVOCATION_DB
+
+REFRESH_TOKEN_EXPIRE_DAYS = 7
+
+
+class RefreshTokenReused(Exception):
+    pass
+
+
+class RefreshTokenStore:
+    def __init__(self,
+                 secret_key: str,
+                 expire_seconds: float = REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+                 path: str = REVOCATION_DB):
+        self.secret_key = secret_key.encode()
+        self.expire_seconds = expire_seconds
+        # One connection for all the threads, only used with self._lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS refresh_tokens ("
+            " family TEXT PRIMARY KEY,"
+            " username TEXT NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " scope_bits INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS refresh_tokens_username"
+            " ON refresh_tokens (username)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS refresh_tokens_expires_at"
+            " ON refresh_tokens (expires_at)"
+        )
+        self.db.commit()
+        self._lock = threading.Lock()
+
+    def _digest(self, token: str) -> str:
+        return hmac.new(self.secret_key, token.encode(),
+                        hashlib.sha256).hexdigest()
+
+    def _new_token(self, family: str) -> Tuple[str, str]:
+        token = f"{family}.{secrets.token_urlsafe(32)}"
+        return token, self._digest(token)
+
+    def issue(self, username: str, scope_bits: int = 0) -> Tuple[str, str]:
+        '''
+        Returns (refresh token, family) for a new login.
+        '''
+        family = secrets.token_hex(8)
+        token, digest = self._new_token(family)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT INTO refresh_tokens"
+                " (family, username, digest, scope_bits, expires_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (family, username, digest, scope_bits,
+                 time.time() + self.expire_seconds),
+            )
+        return token, family
+
+    def rotate(self, token: str) -> Optional[tuple]:
+        '''
+        Returns (username, scope bits, new refresh token, family), keeping
+        the scopes of the original login, or None if the token is
+        unknown or expired. Raises RefreshTokenReused if it was used before.
+        '''
+        family, _, _ = token.partition(".")
+        digest = self._digest(token)
+        new_token, new_digest = self._new_token(family)
+        now = time.time()
+        with self._lock, self.db:
+            # Only if it's still the last token of the family, so of two
+            # workers getting the same token, only one can use it
+            cursor = self.db.execute(
+                "UPDATE refresh_tokens SET digest = ?, expires_at = ?"
+                " WHERE family = ? AND digest = ? AND expires_at > ?",
+                (new_digest, now + self.expire_seconds, family, digest, now),
+            )
+            if cursor.rowcount == 1:
+                username, scope_bits = self.db.execute(
+                    "SELECT username, scope_bits FROM refresh_tokens"
+                    " WHERE family = ?", (family,)
+                ).fetchone()
+                return username, scope_bits, new_token, family
+            row = self.db.execute(
+                "SELECT expires_at FROM refresh_tokens WHERE family = ?",
+                (family,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute("DELETE FROM refresh_tokens WHERE family = ?",
+                            (family,))
+        if row[0] > now:
+            # Not the last token of the family, it was used before
+            raise RefreshTokenReused()
+        return None
+
+    def revoke_family(self, family: str):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM refresh_tokens WHERE family = ?",
+                            (family,))
+
+    def revoke_user(self, username: str):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM refresh_tokens WHERE username = ?",
+                            (username,))
+
+    def prune(self):
+        with self._lock, self.db:
+            self.db.execute(
+                "DELETE FROM refresh_tokens WHERE expires_at <= ?",
+                (time.time(),),
+            )
+
+    def close(self):
+        with self._lock:
+            self.db.close()
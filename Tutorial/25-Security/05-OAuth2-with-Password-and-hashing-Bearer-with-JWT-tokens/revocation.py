@@ -0,0 +1,149 @@
+'''
+Token revocation
+
+A JWT is valid until its "exp", there's no way to "log out" of it. To be
+able to revoke a token before that, each token gets a unique id in the
+"jti" claim, and revoked ids are saved in a small SQLite database.
+
+Almost every token checked is not revoked, so, before going to the
+database, the id is looked up in a Bloom filter kept in memory:
+
+    * If the Bloom filter says "no", the token is surely not revoked.
+    * If it says "maybe", the database has the final answer.
+
+With several workers, a token can be revoked in another one. So, every
+REVOCATION_REFRESH_SECONDS, a background task calls refresh(): the ids
+revoked since the last time are read from the database and added to the
+Bloom filter (each row has an increasing "id", only the new ones are
+read).
+
+Revoked ids are only needed until the token would have expired anyway,
+so prune() removes the old ones and builds the Bloom filter again.
+
+is_revoked() only looks at the Bloom filter in memory, and goes to the
+database in a thread for a "maybe". The other methods are blocking,
+call them in a thread.
+'''
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+REVOCATION_DB = "revoked_tokens.db"
+REVOCATION_CAPACITY = 100_000
+REVOCATION_ERROR_RATE = 0.001
+REVOCATION_PRUNE_SECONDS = 60
+REVOCATION_REFRESH_SECONDS = 1
+
+
+class BloomFilter:
+    def __init__(self,
+                 capacity: int = REVOCATION_CAPACITY,
+                 error_rate: float = REVOCATION_ERROR_RATE):
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(bits))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Two hashes from one digest, combined to get all the positions
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class RevocationList:
+    def __init__(self,
+                 path: str = REVOCATION_DB,
+                 capacity: int = REVOCATION_CAPACITY,
+                 error_rate: float = REVOCATION_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_seconds = REVOCATION_REFRESH_SECONDS
+        # One connection for all the threads, only used with self._lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # AUTOINCREMENT: the ids are never reused, even after a DELETE
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS revoked_tokens ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " jti TEXT NOT NULL UNIQUE,"
+            " expires_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS revoked_tokens_expires_at"
+            " ON revoked_tokens (expires_at)"
+        )
+        self.db.commit()
+        self._lock = threading.Lock()
+        self.prune()
+
+    def revoke(self, jti: str, expires_at: float):
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO revoked_tokens (jti, expires_at)"
+                    " VALUES (?, ?)",
+                    (jti, expires_at),
+                )
+            self.bloom.add(jti)
+
+    def _read_since(self, bloom: BloomFilter, last_id: int) -> int:
+        for row_id, jti in self.db.execute(
+                "SELECT id, jti FROM revoked_tokens WHERE id > ?"
+                " ORDER BY id", (last_id,)):
+            bloom.add(jti)
+            last_id = row_id
+        return last_id
+
+    def refresh(self):
+        '''
+        Adds to the Bloom filter the ids revoked (by any worker) since the
+        last time.
+        '''
+        with self._lock:
+            self._last_id = self._read_since(self.bloom, self._last_id)
+
+    def _in_database(self, jti: str) -> bool:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT 1 FROM revoked_tokens WHERE jti = ?", (jti,)
+            ).fetchone()
+        return row is not None
+
+    async def is_revoked(self, jti: str) -> bool:
+        if jti not in self.bloom:
+            return False
+        return await run_in_threadpool(self._in_database, jti)
+
+    def prune(self):
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    "DELETE FROM revoked_tokens WHERE expires_at <= ?",
+                    (time.time(),),
+                )
+            # A Bloom filter can't forget keys, so build a new one. It
+            # replaces the old one only when complete, is_revoked() can
+            # be using it meanwhile.
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            self._last_id = self._read_since(bloom, 0)
+            self.bloom = bloom
+
+    def close(self):
+        with self._lock:
+            self.db.close()
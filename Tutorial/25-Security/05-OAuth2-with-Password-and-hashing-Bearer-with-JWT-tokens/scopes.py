@@ -0,0 +1,69 @@
+'''
+OAuth2 scopes as bits
+
+Each scope gets one bit. The scopes granted when a token is created are
+saved in it as a single integer ("scope_bits"), and each path operation
+declares the scopes it requires with Security(..., scopes=[...]).
+
+Checking a request is then one AND between the two integers, instead of
+comparing lists or sets of strings:
+
+    granted & required == required
+
+Each scope has its bit written in SCOPE_BITS, not taken from its place
+in SCOPES: the bits are saved in tokens and refresh tokens, so adding,
+removing or moving a scope must not change the bit of the others. A bit
+of a removed scope is not used again.
+
+The path operations declare their scopes with required_scopes(), which
+checks them when the module is imported: a typo fails at startup, not
+with a 500 on the first request. The required bits of each path
+operation are computed the first time and remembered.
+'''
+from functools import lru_cache
+from typing import Iterable, List
+
+SCOPES = {
+    "me": "Read information about the current user.",
+    "items": "Read items.",
+}
+
+SCOPE_BITS = {
+    "me": 1 << 0,
+    "items": 1 << 1,
+}
+
+if SCOPE_BITS.keys() != SCOPES.keys() or \
+        len(set(SCOPE_BITS.values())) != len(SCOPE_BITS):
+    raise ValueError("Each scope needs its own bit in SCOPE_BITS")
+
+
+def scopes_to_bits(scopes: Iterable[str]) -> int:
+    # Unknown scopes requested by a client are not granted
+    bits = 0
+    for scope in scopes:
+        bits |= SCOPE_BITS.get(scope, 0)
+    return bits
+
+
+def bits_to_scopes(bits: int) -> List[str]:
+    return [scope for scope, bit in SCOPE_BITS.items() if bits & bit]
+
+
+def required_scopes(*scopes: str) -> List[str]:
+    '''
+    The scopes for Security(..., scopes=...), checked now.
+    '''
+    required_bits(" ".join(scopes))
+    return list(scopes)
+
+
+@lru_cache(maxsize=None)
+def required_bits(scope_str: str) -> int:
+    bits = 0
+    for scope in scope_str.split():
+        if scope not in SCOPE_BITS:
+            # A typo here would silently allow everything
+            raise ValueError(f"Unknown scope: {scope}")
+        bits |= SCOPE_BITS[scope]
+    return bits
@@ -0,0 +1,79 @@
+'''
+Verified token cache
+
+Each authenticated request decodes the JWT (checking its signature),
+looks the user up and builds a new UserInDB with Pydantic.
+
+A client that sends the same token again and again will get the same
+result every time, until the token expires. So we can keep the user we
+already validated, keyed by the raw token, and skip all that work.
+
+    * The cache is an LRU with a maximum size, old entries are dropped.
+    * An entry is only valid until the "exp" of its token.
+    * The scope bits of the token are kept with the user, as two tokens
+      of the same user can have different scopes.
+    * Its "jti" too, so a cached token can still be checked against the
+      revoked ones (revoked in another worker, for example).
+    * When something changes about a user (e.g. it is disabled), all the
+      tokens of that user are removed with invalidate_user().
+'''
+import time
+from collections import OrderedDict
+from typing import Dict, Set
+
+TOKEN_CACHE_SIZE = 10_000
+
+
+class TokenCache:
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        # token -> (expires at, username, user, scope bits, jti)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str):
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        expires_at, username, user, scope_bits, jti = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            return None
+        self._entries.move_to_end(token)
+        return user, scope_bits, jti
+
+    def set(self, token: str, user, expires_at: float, scope_bits: int = 0,
+            jti: str = ""):
+        if self.max_size <= 0:
+            return
+        if token in self._entries:
+            self._remove(token)
+        self._entries[token] = (expires_at, user.username, user, scope_bits,
+                                jti)
+        self._tokens_by_user.setdefault(user.username, set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def invalidate_token(self, token: str):
+        if token in self._entries:
+            self._remove(token)
+
+    def invalidate_user(self, username: str):
+        for token in self._tokens_by_user.pop(username, set()):
+            self._entries.pop(token, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        username = self._entries.pop(token)[1]
+        tokens = self._tokens_by_user.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[username]
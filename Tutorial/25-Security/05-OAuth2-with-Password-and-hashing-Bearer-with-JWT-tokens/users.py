@@ -0,0 +1,227 @@
+'''
+User repository
+
+The path operations don't need to know where the users are saved, they
+only need to get one by username (or email), and update it.
+
+UserRepository declares those operations, and there are a few ways to
+implement it:
+
+    * InMemoryUserRepository: a dict, like fake_users_db.
+    * SQLiteUserRepository: a SQLite database with indexes on username
+      and email, and a small pool of connections that are reused.
+    * CachedUserRepository: wraps another repository and keeps the
+      validated Pydantic objects for USERS_CACHE_TTL seconds, so a user
+      read many times is only queried and built once in that time.
+      update() clears the user from the cache of this process, the TTL
+      is how long a change made by another worker (or straight in the
+      database) can take to be seen here.
+
+add_many() inserts the users, or updates the ones already there, so a
+change in fake_users_db reaches a database made by an earlier start.
+
+Each user also has "scopes": the OAuth2 scopes it can be granted,
+separated by spaces.
+
+The lessons 04 and 05 of 25-Security each have a copy of this file, so
+both run on their own. Change them together.
+'''
+import queue
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable
+
+USERS_POOL_SIZE = 4
+USERS_CACHE_SIZE = 10_000
+USERS_CACHE_TTL = 5  # seconds
+
+USER_FIELDS = ("username", "email", "full_name", "hashed_password", "disabled",
+               "scopes")
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    def get(self, username: str):
+        pass
+
+    @abstractmethod
+    def get_by_email(self, email: str):
+        pass
+
+    @abstractmethod
+    def add_many(self, users: Iterable[dict]):
+        pass
+
+    @abstractmethod
+    def update(self, username: str, **fields):
+        pass
+
+
+class InMemoryUserRepository(UserRepository):
+    def __init__(self, db: Dict[str, dict], model):
+        self.db = db
+        self.model = model
+        self._emails = {user["email"]: username
+                        for username, user in db.items() if user.get("email")}
+
+    def get(self, username: str):
+        if username in self.db:
+            return self.model(**self.db[username])
+
+    def get_by_email(self, email: str):
+        username = self._emails.get(email)
+        if username is not None:
+            return self.get(username)
+
+    def add_many(self, users: Iterable[dict]):
+        for user in users:
+            self.db[user["username"]] = dict(user)
+            if user.get("email"):
+                self._emails[user["email"]] = user["username"]
+
+    def update(self, username: str, **fields):
+        if username not in self.db:
+            return
+        old_email = self.db[username].get("email")
+        self.db[username].update(fields)
+        if "email" in fields:
+            self._emails.pop(old_email, None)
+            if fields["email"]:
+                self._emails[fields["email"]] = username
+
+
+class SQLiteUserRepository(UserRepository):
+    # Always the same SQL strings, so each connection compiles them
+    # only once and reuses the prepared statement after that.
+    SELECT_BY_USERNAME = (
+        "SELECT username, email, full_name, hashed_password, disabled,"
+        " scopes FROM users WHERE username = ?"
+    )
+    SELECT_BY_EMAIL = (
+        "SELECT username, email, full_name, hashed_password, disabled,"
+        " scopes FROM users WHERE email = ?"
+    )
+    UPSERT = (
+        "INSERT INTO users"
+        " (username, email, full_name, hashed_password, disabled, scopes)"
+        " VALUES (?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT (username) DO UPDATE SET"
+        " email = excluded.email, full_name = excluded.full_name,"
+        " hashed_password = excluded.hashed_password,"
+        " disabled = excluded.disabled, scopes = excluded.scopes"
+    )
+
+    def __init__(self, path: str, model, pool_size: int = USERS_POOL_SIZE):
+        self.model = model
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(pool_size):
+            connection = sqlite3.connect(path, check_same_thread=False,
+                                         cached_statements=64)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._pool.put(connection)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " username TEXT PRIMARY KEY,"
+                " email TEXT,"
+                " full_name TEXT,"
+                " hashed_password TEXT NOT NULL,"
+                " disabled INTEGER NOT NULL DEFAULT 0,"
+                " scopes TEXT NOT NULL DEFAULT '')"
+            )
+            connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS users_email"
+                " ON users (email)"
+            )
+
+    @contextmanager
+    def _connection(self):
+        connection = self._pool.get()
+        try:
+            with connection:
+                yield connection
+        finally:
+            self._pool.put(connection)
+
+    def _get_one(self, sql: str, value: str):
+        with self._connection() as connection:
+            row = connection.execute(sql, (value,)).fetchone()
+        if row is not None:
+            return self.model(**dict(row))
+
+    def get(self, username: str):
+        return self._get_one(self.SELECT_BY_USERNAME, username)
+
+    def get_by_email(self, email: str):
+        return self._get_one(self.SELECT_BY_EMAIL, email)
+
+    def add_many(self, users: Iterable[dict]):
+        rows = (
+            (user["username"], user.get("email"), user.get("full_name"),
+             user["hashed_password"], bool(user.get("disabled")),
+             user.get("scopes", ""))
+            for user in users
+        )
+        with self._connection() as connection:
+            connection.executemany(self.UPSERT, rows)
+
+    def update(self, username: str, **fields):
+        names = [name for name in fields if name in USER_FIELDS]
+        if not names:
+            return
+        assignments = ", ".join(f"{name} = ?" for name in names)
+        values = [fields[name] for name in names]
+        with self._connection() as connection:
+            connection.execute(
+                f"UPDATE users SET {assignments} WHERE username = ?",
+                (*values, username),
+            )
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get().close()
+
+
+class CachedUserRepository(UserRepository):
+    def __init__(self, repository: UserRepository,
+                 max_size: int = USERS_CACHE_SIZE,
+                 ttl: float = USERS_CACHE_TTL):
+        self.repository = repository
+        self.max_size = max_size
+        self.ttl = ttl
+        # username -> (expiration, user)
+        self._users: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, username: str):
+        entry = self._users.get(username)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self._users.move_to_end(username)
+            return entry[1]
+        user = self.repository.get(username)
+        if user is not None and self.max_size > 0:
+            self._users[username] = (now + self.ttl, user)
+            self._users.move_to_end(username)
+            if len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+        return user
+
+    def get_by_email(self, email: str):
+        return self.repository.get_by_email(email)
+
+    def add_many(self, users: Iterable[dict]):
+        users = list(users)
+        self.repository.add_many(users)
+        for user in users:
+            self.invalidate(user["username"])
+
+    def update(self, username: str, **fields):
+        self.repository.update(username, **fields)
+        self.invalidate(username)
+
+    def invalidate(self, username: str):
+        self._users.pop(username, None)
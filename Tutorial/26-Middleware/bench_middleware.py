@@ -0,0 +1,86 @@
+'''
+Middleware benchmark
+
+Throughput of the hello world "/" route from 01-First-Steps:
+
+    * without any middleware,
+    * with add_process_time_header as @app.middleware("http"),
+    * with ProcessTimeMiddleware (ASGI).
+
+The app is called directly with ASGI messages, no server or HTTP client,
+so the numbers only include the app and its middleware.
+
+Run it with:
+
+$ python bench_middleware.py [requests]
+'''
+import asyncio
+import sys
+import time
+
+from fastapi import FastAPI
+
+from main import add_process_time_header
+from process_time import ProcessTimeMiddleware
+
+
+def hello_world_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/")
+    async def root():
+        return {"message": "Hello World"}
+
+    return app
+
+
+SCOPE = {
+    "type": "http",
+    "asgi": {"version": "3.0"},
+    "http_version": "1.1",
+    "method": "GET",
+    "scheme": "http",
+    "path": "/",
+    "raw_path": b"/",
+    "root_path": "",
+    "query_string": b"",
+    "headers": [(b"host", b"test")],
+    "client": ("127.0.0.1", 12345),
+    "server": ("test", 80),
+}
+
+
+async def run_requests(app, count: int) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # Warm up, the first request builds the middleware stack
+    await app(dict(SCOPE), receive, send)
+    start = time.perf_counter()
+    for _ in range(count):
+        await app(dict(SCOPE), receive, send)
+    return time.perf_counter() - start
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    plain = hello_world_app()
+    decorated = hello_world_app()
+    decorated.middleware("http")(add_process_time_header)
+    asgi = hello_world_app()
+    asgi.add_middleware(ProcessTimeMiddleware)
+
+    print(f"{count} requests to /")
+    for label, app in (("no middleware", plain),
+                       ("@app.middleware", decorated),
+                       ("ASGI middleware", asgi)):
+        elapsed = asyncio.run(run_requests(app, count))
+        print(f"{label:>16}: {count / elapsed:9.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,139 @@
+'''
+Event loop monitor
+
+An async def path operation that calls blocking code (a slow hash, a big
+file read, a sync HTTP client...) holds the event loop, and no other
+request on the worker can make progress until it returns.
+
+Lag
+
+A background task asks to sleep for LOOP_MONITOR_INTERVAL and measures
+how late it wakes up. That delay is how long any other coroutine would
+have waited to run. It is recorded in a histogram and shown at /metrics
+as event_loop_lag_seconds.
+
+Blocking calls (debug)
+
+With debug=True, a watchdog thread also checks that the background task
+keeps running. If the loop doesn't come back for more than
+LOOP_BLOCK_THRESHOLD, it takes the stack of the event loop thread and the
+route of the request being run at that moment, logs them, and counts it
+in event_loop_blocked_total{route=...}.
+'''
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Dict, Optional
+
+from metrics import (OTHER, UNMATCHED, LatencyHistogram, escape_label,
+                     summary_lines)
+
+LOOP_MONITOR_INTERVAL = 0.05
+LOOP_BLOCK_THRESHOLD = 0.2
+MAX_BLOCKED_ROUTES = 200
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    def __init__(self,
+                 interval: float = LOOP_MONITOR_INTERVAL,
+                 block_threshold: float = LOOP_BLOCK_THRESHOLD,
+                 debug: bool = False):
+        if block_threshold <= interval:
+            raise ValueError("block_threshold must be more than interval")
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.debug = debug
+        self.lag = LatencyHistogram()
+        self.blocked: Counter = Counter()
+        # Requests running now: task -> ASGI scope (only in debug)
+        self.requests: Dict[asyncio.Task, dict] = {}
+        self._heartbeat = time.perf_counter()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        if self.debug:
+            threading.Thread(target=self._watchdog,
+                             name="loop-watchdog",
+                             daemon=True).start()
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                await asyncio.sleep(self.interval)
+                lag = time.perf_counter_ns() - start - int(self.interval * 1e9)
+                self.lag.record(max(0, lag))
+                self._heartbeat = time.perf_counter()
+        finally:
+            self._stopped.set()
+
+    def _watchdog(self):
+        reported = None
+        while not self._stopped.wait(self.block_threshold / 4):
+            heartbeat = self._heartbeat
+            blocked_for = time.perf_counter() - heartbeat
+            # One report for each time the loop is blocked
+            if blocked_for > self.block_threshold and heartbeat != reported:
+                reported = heartbeat
+                self._report(blocked_for)
+
+    def _report(self, blocked_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        task = asyncio.current_task(self._loop)
+        scope = self.requests.get(task)
+        if scope is None:
+            route = OTHER
+        else:
+            route = getattr(scope.get("route"), "path", UNMATCHED)
+        if route not in self.blocked and \
+                len(self.blocked) >= MAX_BLOCKED_ROUTES:
+            route = OTHER
+        self.blocked[route] += 1
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        logger.warning("Event loop blocked for %.3f s by %s\n%s",
+                       blocked_for, route, stack)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP event_loop_lag_seconds Delay to run a ready coroutine.",
+            "# TYPE event_loop_lag_seconds summary",
+        ]
+        lines.extend(summary_lines("event_loop_lag_seconds", "", self.lag))
+        if self.debug:
+            lines.append("# HELP event_loop_blocked_total "
+                          "Times a request held the event loop too long.")
+            lines.append("# TYPE event_loop_blocked_total counter")
+            for route, count in sorted(self.blocked.items()):
+                lines.append(f'event_loop_blocked_total'
+                             f'{{route="{escape_label(route)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+class LoopMonitorMiddleware:
+    '''
+    In debug mode, remembers which request each task is running, so a
+    blocked loop can be blamed on a route.
+    '''
+    def __init__(self, app, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.monitor.debug:
+            await self.app(scope, receive, send)
+            return
+        task = asyncio.current_task()
+        self.monitor.requests[task] = scope
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.monitor.requests.pop(task, None)
@@ -1,5 +1,18 @@
+import asyncio
+import secrets
 import time
-from fastapi import FastAPI, Request
+from typing import Optional
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+
+from loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from metrics import LatencyMetrics, LatencyMiddleware
+from process_time import ProcessTimeMiddleware
+from profiling import (PROFILING_FLUSH_SECONDS, PROFILING_TOKEN,
+                       ProfilingMiddleware, SamplingProfiler)
+from tracing import SlowRequestMiddleware, TracedRoute
 
 '''
 Middleware
@@ -45,10 +58,15 @@ The middleware function receives:
 
 '''
 
-app = FastAPI()
+# Report async path operations that block the event loop
+DEBUG = False
 
+app = FastAPI(debug=DEBUG)
+# Time each phase of the requests, for the slow request log (see tracing.py)
+app.router.route_class = TracedRoute
 
-@app.middleware("http")
+
+# This is how it looks with @app.middleware("http"):
 async def add_process_time_header(request: Request, call_next):
     start_time = time.time()
     response = await call_next(request)
@@ -56,6 +74,101 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
+
+# But the app uses the same header from an ASGI middleware, that is
+# faster and keeps streaming responses working (see process_time.py).
+# To use the function above instead:
+# app.middleware("http")(add_process_time_header)
+app.add_middleware(ProcessTimeMiddleware)
+
+# Latency histograms per route, shown at /metrics (see metrics.py)
+metrics = LatencyMetrics()
+app.add_middleware(LatencyMiddleware, metrics=metrics)
+
+# Event loop lag, and blocking calls in debug (see loop_monitor.py)
+loop_monitor = LoopMonitor(debug=DEBUG)
+app.add_middleware(LoopMonitorMiddleware, monitor=loop_monitor)
+
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    app.state.loop_monitor_task = asyncio.create_task(loop_monitor.run())
+
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    app.state.loop_monitor_task.cancel()
+
+
+# Log the requests slower than this, with the time of each phase
+SLOW_REQUEST_SECONDS = 0.5
+app.add_middleware(SlowRequestMiddleware, threshold=SLOW_REQUEST_SECONDS)
+
+# Off until turned on at /admin/profiling (see profiling.py)
+profiler = SamplingProfiler()
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+
+class ProfilingSettings(BaseModel):
+    enabled: bool
+    sample_rate: float = Field(0.01, ge=0, le=1)
+
+
+async def verify_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if PROFILING_TOKEN is None:
+        # Without a token the endpoint is not there
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or \
+            not secrets.compare_digest(x_admin_token, PROFILING_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/profiling", response_model=ProfilingSettings,
+         dependencies=[Depends(verify_admin_token)])
+async def read_profiling():
+    return {"enabled": profiler.enabled, "sample_rate": profiler.sample_rate}
+
+
+@app.put("/admin/profiling", response_model=ProfilingSettings,
+         dependencies=[Depends(verify_admin_token)])
+async def update_profiling(settings: ProfilingSettings):
+    profiler.sample_rate = settings.sample_rate
+    profiler.enabled = settings.enabled
+    if not settings.enabled:
+        # Write what was collected while it was on
+        await run_in_threadpool(profiler.flush)
+    return settings
+
+
+async def flush_profiles_periodically():
+    # A crash only loses what was collected since the last one
+    while True:
+        await asyncio.sleep(PROFILING_FLUSH_SECONDS)
+        await run_in_threadpool(profiler.flush)
+
+
+@app.on_event("startup")
+async def start_flushing_profiles():
+    app.state.profile_flush_task = asyncio.create_task(
+        flush_profiles_periodically())
+
+
+@app.on_event("shutdown")
+def flush_profiles():
+    app.state.profile_flush_task.cancel()
+    profiler.flush()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(metrics.render() + loop_monitor.render(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.get("/items/{item_id}")
+async def read_item(item_id: int):
+    return {"item_id": item_id}
+
 '''
 Tip
 
@@ -0,0 +1,156 @@
+'''
+Latency metrics
+
+The X-Process-Time header tells one client how long its request took, but
+there's nothing to aggregate. Here each request duration is recorded in a
+histogram per route, and /metrics shows the p50, p95 and p99 of each one
+in the Prometheus text format.
+
+Histogram
+
+Like an HDR histogram, each power of two of nanoseconds is split in
+SUB_BUCKETS buckets, so every value is recorded with an error of at most
+1/SUB_BUCKETS (about 6%), from 1 nanosecond to more than an hour, in a
+fixed array of counters. Recording a value is a few bit operations.
+
+Bounded memory
+
+The histograms are per route template ("/items/{item_id}"), not per raw
+path ("/items/1", "/items/2", ...), requests that don't match any route
+share the "<unmatched>" one, and after MAX_SERIES histograms the rest go
+to "<other>" (the same for unknown HTTP methods). So memory doesn't depend
+on the paths clients send.
+'''
+import time
+from array import array
+from typing import Dict, Tuple
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 42  # 2 ** 42 ns, more than an hour
+MAX_SERIES = 200
+QUANTILES = (0.5, 0.95, 0.99)
+
+UNMATCHED = "<unmatched>"
+OTHER = "<other>"
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+# Values below this are recorded exactly, one bucket per nanosecond
+_LINEAR = SUB_BUCKETS * 2
+_SIZE = _LINEAR + (MAX_BITS - SUB_BUCKET_BITS - 1) * SUB_BUCKETS
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "total_ns")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * _SIZE))
+        self.count = 0
+        self.total_ns = 0
+
+    @staticmethod
+    def _index(value_ns: int) -> int:
+        if value_ns < _LINEAR:
+            return max(0, value_ns)
+        shift = value_ns.bit_length() - SUB_BUCKET_BITS - 1
+        index = _LINEAR + (shift - 1) * SUB_BUCKETS + \
+            (value_ns >> shift) - SUB_BUCKETS
+        return min(index, _SIZE - 1)
+
+    @staticmethod
+    def _highest_value(index: int) -> int:
+        if index < _LINEAR:
+            return index
+        shift = (index - _LINEAR) // SUB_BUCKETS + 1
+        sub = (index - _LINEAR) % SUB_BUCKETS + SUB_BUCKETS
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value_ns: int):
+        self.counts[self._index(value_ns)] += 1
+        self.count += 1
+        self.total_ns += value_ns
+
+    def quantile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self._highest_value(index)
+        return self._highest_value(_SIZE - 1)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def summary_lines(name: str, labels: str, histogram: LatencyHistogram):
+    # labels is already formatted, e.g. 'method="GET",route="/"'
+    prefix = f"{labels}," if labels else ""
+    braces = f"{{{labels}}}" if labels else ""
+    for q in QUANTILES:
+        seconds = histogram.quantile(q) / 1e9
+        yield f'{name}{{{prefix}quantile="{q}"}} {seconds:.9f}'
+    yield f"{name}_sum{braces} {histogram.total_ns / 1e9:.9f}"
+    yield f"{name}_count{braces} {histogram.count}"
+
+
+class LatencyMetrics:
+    def __init__(self,
+                 name: str = "http_request_duration_seconds",
+                 max_series: int = MAX_SERIES):
+        self.name = name
+        self.max_series = max_series
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+
+    def record(self, method: str, route: str, duration_ns: int):
+        # The method also comes from the client
+        if method not in METHODS:
+            method = OTHER
+        key = (method, route)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            if len(self.histograms) >= self.max_series:
+                key = (method, OTHER)
+                histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(duration_ns)
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} Request duration by route.",
+            f"# TYPE {self.name} summary",
+        ]
+        for (method, route), histogram in sorted(self.histograms.items()):
+            labels = f'method="{method}",route="{escape_label(route)}"'
+            lines.extend(summary_lines(self.name, labels, histogram))
+        return "\n".join(lines) + "\n"
+
+
+class LatencyMiddleware:
+    '''
+    ASGI middleware that records the duration of each HTTP request,
+    until the whole response is sent, in a LatencyMetrics.
+    '''
+    def __init__(self, app, metrics: LatencyMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start_time = time.perf_counter_ns()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router saves the matched route in the scope, use its
+            # template and not the raw path
+            route = scope.get("route")
+            self.metrics.record(scope["method"],
+                                getattr(route, "path", UNMATCHED),
+                                time.perf_counter_ns() - start_time)
@@ -0,0 +1,37 @@
+'''
+X-Process-Time as an ASGI middleware
+
+@app.middleware("http") is built on Starlette's BaseHTTPMiddleware. To give
+the function a response it can modify, it runs the rest of the app in
+another task and passes the body through a memory stream, which costs
+time on every request and doesn't work well with streaming responses.
+
+A "raw" ASGI middleware is just a class that receives the app, and is
+called with (scope, receive, send). Here it only wraps send, to add the
+header to the "http.response.start" message, and lets everything else
+(including the body, chunk by chunk) go through untouched.
+'''
+import time
+
+from starlette.datastructures import MutableHeaders
+
+
+class ProcessTimeMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+
+        async def send_with_process_time(message):
+            if message["type"] == "http.response.start":
+                process_time = time.perf_counter() - start_time
+                headers = MutableHeaders(scope=message)
+                headers.append("X-Process-Time", str(process_time))
+            await send(message)
+
+        await self.app(scope, receive, send_with_process_time)
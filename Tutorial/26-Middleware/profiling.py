@@ -0,0 +1,181 @@
+'''
+Sampling profiler
+
+To find what is slow in production we can't profile every request, that
+would make all of them slower. Instead, when it's turned on, only a
+fraction of the requests (sample_rate) is profiled, plus the requests
+that ask for it with the header "X-Profile: <PROFILING_TOKEN>".
+
+PROFILING_TOKEN comes from the environment variable of the same name
+(e.g. PROFILING_TOKEN=$(openssl rand -hex 32) ./run.sh). Without it the
+X-Profile header is ignored, and main.py hides /admin/profiling (404),
+so profiling can't be turned on at all.
+
+While a profiled request is running, a background thread looks at the
+stack of the event loop thread every few milliseconds. If the task
+running at that moment is a profiled request, the stack is counted for
+it. When the request finishes, its stacks are added to the ones of its
+route.
+
+flush() writes them in "collapsed stack" format, one file per route in
+PROFILES_DIR, with lines like:
+
+    main.py:read_item;crud.py:get_item;json:dumps 12
+
+which you can turn into a flamegraph with flamegraph.pl or speedscope.
+main.py calls it every PROFILING_FLUSH_SECONDS, so a crash only loses the
+last few stacks, and at shutdown. The name of each file is the route made
+safe for a file name, and a hash of the route: "GET /a/b" and "GET /a_b"
+would both be "GET_a_b", the hash keeps them apart.
+
+Only code running in the event loop thread is seen, normal def path
+operations run in a threadpool and are not sampled.
+'''
+import asyncio
+import hashlib
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Optional
+
+PROFILES_DIR = "profiles"
+PROFILING_SAMPLE_RATE = 0.01
+PROFILING_INTERVAL = 0.005  # seconds between stack samples
+PROFILING_FLUSH_SECONDS = 60
+# Not set: no one can turn profiling on (see above)
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN") or None
+
+UNMATCHED = "<unmatched>"
+
+
+def collapse_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        name = getattr(code, "co_qualname", code.co_name)
+        names.append(f"{os.path.basename(code.co_filename)}:{name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self,
+                 output_dir: str = PROFILES_DIR,
+                 sample_rate: float = PROFILING_SAMPLE_RATE,
+                 interval: float = PROFILING_INTERVAL,
+                 token: Optional[str] = PROFILING_TOKEN):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.token = token
+        self.enabled = False
+        # Profiled requests running now: task -> their stacks
+        self._active: Dict[asyncio.Task, Counter] = {}
+        # Stacks of the finished requests, by route
+        self._stacks: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        # Two flushes don't write the same file at the same time
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+
+    def should_profile(self, header_value: Optional[bytes]) -> bool:
+        if header_value is not None and self.token is not None and \
+                secrets.compare_digest(header_value, self.token.encode()):
+            return True
+        return self.enabled and random.random() < self.sample_rate
+
+    def start_request(self):
+        task = asyncio.current_task()
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._thread = threading.Thread(target=self._run,
+                                            name="sampling-profiler",
+                                            daemon=True)
+            self._thread.start()
+        with self._lock:
+            self._active[task] = Counter()
+        self._wakeup.set()
+
+    def finish_request(self, method: str, route: str):
+        task = asyncio.current_task()
+        with self._lock:
+            stacks = self._active.pop(task, None)
+            if stacks:
+                self._stacks[f"{method} {route}"].update(stacks)
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            time.sleep(self.interval)
+            self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        # The task the event loop is running right now, if any
+        task = asyncio.current_task(self._loop)
+        with self._lock:
+            stacks = self._active.get(task)
+            if stacks is not None:
+                stacks[collapse_stack(frame)] += 1
+
+    def path(self, route: str) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.{}-]+", "_", route).strip("_")
+        digest = hashlib.sha256(route.encode()).hexdigest()[:8]
+        return os.path.join(self.output_dir, f"{name}-{digest}.collapsed")
+
+    def flush(self):
+        '''
+        Appends the stacks collected since the last flush to the files.
+        Blocking, call it in a thread.
+        '''
+        with self._lock:
+            stacks, self._stacks = self._stacks, defaultdict(Counter)
+        if not stacks:
+            return
+        with self._flush_lock:
+            os.makedirs(self.output_dir, exist_ok=True)
+            for route, counts in stacks.items():
+                # Appending is fine, the tools add up repeated stacks
+                with open(self.path(route), "a") as f:
+                    for stack, count in counts.items():
+                        f.write(f"{stack} {count}\n")
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, profiler: SamplingProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        header_value = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                header_value = value
+                break
+        if not self.profiler.should_profile(header_value):
+            await self.app(scope, receive, send)
+            return
+        self.profiler.start_request()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            self.profiler.finish_request(scope["method"],
+                                         getattr(route, "path", UNMATCHED))
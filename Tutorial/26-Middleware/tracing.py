@@ -0,0 +1,263 @@
+'''
+Slow request log
+
+X-Process-Time and the histograms in /metrics say that a request was slow,
+not where the time went. For that, each request is split in phases:
+
+    * body: reading and parsing the request body (JSON or form).
+    * dependencies: solving the parameters and the Depends(...)
+      functions, before the endpoint is called.
+    * endpoint: the path operation function itself.
+    * serialize: validating the return value with the response_model and
+      rendering it (e.g. to JSON).
+    * send: sending the response to the client.
+    * other: the rest (routing, parameter validation, middleware, waiting
+      for the threadpool...).
+
+When a request takes more than SLOW_REQUEST_SECONDS, one JSON line with the
+breakdown is logged, like:
+
+    {"method": "GET", "route": "/users/me", "status": 200, "total_ms": 812.4,
+     "phases": {"body": 0.0, "dependencies": 790.1, "endpoint": 0.2, ...},
+     "dependencies": {"get_current_user": 789.9}}
+
+How
+
+TracedRoute is a custom APIRoute class (set it with
+app.router.route_class = TracedRoute before declaring the path
+operations). It times the body with a Request subclass and wraps the
+endpoint function with a timer, the time before it is the dependencies.
+SlowRequestMiddleware starts the trace of each request, times the send
+and writes the log line.
+
+The time of each dependency, by name, is only there for the ones declared
+with traced(): Depends(traced(get_db)) instead of Depends(get_db). It is
+a dependency that depends on get_db, FastAPI still solves get_db itself,
+so app.dependency_overrides[get_db] = ... in the tests works as usual.
+The time of a dependency includes its own sub-dependencies.
+'''
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+from fastapi import Depends
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+
+SLOW_REQUEST_SECONDS = 0.5
+
+UNMATCHED = "<unmatched>"
+
+logger = logging.getLogger("slow_requests")
+
+
+class RequestTrace:
+    __slots__ = ("phases", "dependencies", "endpoint_start", "endpoint_end",
+                 "_open")
+
+    def __init__(self):
+        self.phases: Dict[str, int] = {}
+        self.dependencies: Dict[str, int] = {}
+        self.endpoint_start: Optional[int] = None
+        self.endpoint_end: Optional[int] = None
+        self._open = set()
+
+    def add(self, phase: str, duration_ns: int):
+        self.phases[phase] = self.phases.get(phase, 0) + duration_ns
+
+    def add_dependency(self, name: str, duration_ns: int):
+        # Already in the "dependencies" phase
+        self.dependencies[name] = \
+            self.dependencies.get(name, 0) + duration_ns
+
+
+current_trace: ContextVar[Optional[RequestTrace]] = \
+    ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def timed(phase: str):
+    trace = current_trace.get()
+    # request.json() calls request.body(), count the time only once
+    if trace is None or phase in trace._open:
+        yield
+        return
+    trace._open.add(phase)
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        trace.add(phase, time.perf_counter_ns() - start)
+        trace._open.discard(phase)
+
+
+def _is_async(call) -> bool:
+    if inspect.isclass(call):
+        return False
+    return asyncio.iscoroutinefunction(call) or \
+        asyncio.iscoroutinefunction(getattr(call, "__call__", None))
+
+
+def _wrap(call: Callable, record: Callable[[RequestTrace, int], None]):
+    if _is_async(call):
+        @functools.wraps(call)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                trace = current_trace.get()
+                if trace is not None:
+                    record(trace, start)
+    else:
+        @functools.wraps(call)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                trace = current_trace.get()
+                if trace is not None:
+                    record(trace, start)
+    return wrapper
+
+
+# The same function gets the same wrapper in every route, FastAPI uses it
+# as the key to call a dependency only once per request.
+_traced_dependencies: Dict[Callable, Callable] = {}
+
+
+def _start_timer() -> int:
+    return time.perf_counter_ns()
+
+
+def traced(dependency: Callable) -> Callable:
+    '''
+    A dependency with the value of dependency, that adds its time to the
+    "dependencies" of the log line.
+    '''
+    wrapper = _traced_dependencies.get(dependency)
+    if wrapper is None:
+        name = getattr(dependency, "__name__", type(dependency).__name__)
+
+        # The parameters are solved in order: the timer starts right
+        # before dependency (or its override) is called
+        async def wrapper(
+                started: int = Depends(_start_timer, use_cache=False),
+                value=Depends(dependency)):
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_dependency(name, time.perf_counter_ns() - started)
+            return value
+
+        wrapper.__name__ = f"traced_{name}"
+        _traced_dependencies[dependency] = wrapper
+    return wrapper
+
+
+def _record_endpoint(trace: RequestTrace, start: int):
+    trace.endpoint_start = start
+    trace.endpoint_end = time.perf_counter_ns()
+    trace.add("endpoint", trace.endpoint_end - start)
+
+
+class TracedRequest(Request):
+    async def body(self) -> bytes:
+        with timed("body"):
+            return await super().body()
+
+    async def json(self):
+        with timed("body"):
+            return await super().json()
+
+    # form() only wraps this one so it also works with "async with"
+    async def _get_form(self, **kwargs):
+        with timed("body"):
+            return await super()._get_form(**kwargs)
+
+
+class TracedRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        # FastAPI reads the parameters of the endpoint through the
+        # wrapper (functools.wraps), the dependencies are not touched
+        super().__init__(path, _wrap(endpoint, _record_endpoint), **kwargs)
+
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def traced_route_handler(request: Request):
+            request = TracedRequest(request.scope, request.receive)
+            trace = current_trace.get()
+            start = time.perf_counter_ns()
+            try:
+                response = await original_route_handler(request)
+            finally:
+                if trace is not None:
+                    # Until the endpoint started, or a dependency raised
+                    end = trace.endpoint_start or time.perf_counter_ns()
+                    trace.add("dependencies", max(
+                        0, end - start - trace.phases.get("body", 0)))
+            if trace is not None and trace.endpoint_end is not None:
+                trace.add("serialize",
+                          time.perf_counter_ns() - trace.endpoint_end)
+            return response
+
+        return traced_route_handler
+
+
+def _ms(duration_ns: int) -> float:
+    return round(duration_ns / 1e6, 3)
+
+
+class SlowRequestMiddleware:
+    def __init__(self, app, threshold: float = SLOW_REQUEST_SECONDS):
+        self.app = app
+        self.threshold_ns = int(threshold * 1e9)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = RequestTrace()
+        token = current_trace.set(trace)
+        status_code = 500
+        send_start = None
+
+        async def send_wrapper(message):
+            nonlocal status_code, send_start
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                send_start = time.perf_counter_ns()
+            await send(message)
+            if message["type"] == "http.response.body" and \
+                    not message.get("more_body", False):
+                trace.add("send", time.perf_counter_ns() - send_start)
+
+        start_time = time.perf_counter_ns()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            total = time.perf_counter_ns() - start_time
+            if total > self.threshold_ns:
+                self.log(scope, status_code, total, trace)
+
+    def log(self, scope, status_code: int, total: int, trace: RequestTrace):
+        phases = dict(trace.phases)
+        phases["other"] = max(0, total - sum(phases.values()))
+        route = scope.get("route")
+        logger.warning(json.dumps({
+            "method": scope["method"],
+            "route": getattr(route, "path", UNMATCHED),
+            "status": status_code,
+            "total_ms": _ms(total),
+            "phases": {name: _ms(ns) for name, ns in phases.items()},
+            "dependencies": {name: _ms(ns)
+                             for name, ns in trace.dependencies.items()},
+        }))
@@ -0,0 +1,101 @@
+'''
+CORS benchmark
+
+Preflight (OPTIONS) and simple (GET) requests per second with Starlette's
+CORSMiddleware and with the one in cors.py, allowing a number of tenant
+origins ("https://tenant<n>.example.com"). The requests come from the last
+tenant, the worst case for a list.
+
+The app is called directly with ASGI messages, no server or HTTP client,
+so the numbers only include the app and its middleware.
+
+Run it with:
+
+$ python bench_cors.py [origins] [requests]
+'''
+import asyncio
+import sys
+import time
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware as StarletteCORSMiddleware
+
+from cors import CORSMiddleware
+
+
+def cors_app(middleware_class, origins) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(
+        middleware_class,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    @app.get("/")
+    async def main():
+        return {"message": "Hello World"}
+
+    return app
+
+
+def make_scope(method: str, headers) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"test")] + headers,
+        "client": ("127.0.0.1", 12345),
+        "server": ("test", 80),
+    }
+
+
+async def run_requests(app, scope: dict, count: int) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # Warm up, the first request builds the middleware stack
+    await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(count):
+        await app(dict(scope), receive, send)
+    return time.perf_counter() - start
+
+
+def main_bench():
+    tenants = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    origins = [f"https://tenant{n}.example.com" for n in range(tenants)]
+    origin = origins[-1].encode()
+    preflight = make_scope("OPTIONS", [
+        (b"origin", origin),
+        (b"access-control-request-method", b"POST"),
+        (b"access-control-request-headers", b"authorization, content-type"),
+    ])
+    simple = make_scope("GET", [(b"origin", origin)])
+
+    print(f"{tenants} origins, {count} requests of each")
+    for label, app in (
+            ("Starlette", cors_app(StarletteCORSMiddleware, origins)),
+            ("cors.py", cors_app(CORSMiddleware, origins)),
+            ("cors.py *.", cors_app(CORSMiddleware,
+                                    ["https://*.example.com"]))):
+        for kind, scope in (("preflight", preflight), ("GET", simple)):
+            elapsed = asyncio.run(run_requests(app, scope, count))
+            print(f"{label:>10} {kind:>9}: {count / elapsed:9.0f} "
+                  f"requests/s")
+
+
+if __name__ == "__main__":
+    main_bench()
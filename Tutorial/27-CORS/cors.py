@@ -0,0 +1,147 @@
+'''
+CORS with many origins
+
+Starlette's CORSMiddleware checks the Origin of each request with
+"origin in allow_origins", and allow_origins is the list we give it. With
+a few origins that's nothing, with hundreds of tenants it's a comparison
+with each one of them, on every request and every preflight.
+
+This CORSMiddleware takes the same parameters and:
+
+    * Compiles the origins once: the exact ones go in a set, and the
+      wildcard ones, like "https://*.example.com", in a trie of domain
+      labels read from the end ("com" -> "example"). Checking an origin is
+      a set lookup plus one step per label of its domain, no matter how
+      many origins are allowed.
+    * Remembers the preflight (OPTIONS) response of each (origin, method,
+      headers) and sends it again without building it, keeping only the
+      last PREFLIGHT_CACHE_SIZE.
+    * Sends Access-Control-Max-Age (CORS_MAX_AGE) so browsers remember
+      the preflight too and don't send it before each request.
+
+"https://*.example.com" allows any subdomain of example.com with https on
+the default port ("https://a.example.com", "https://a.b.example.com"), but
+not "https://example.com" itself, add it too if needed.
+'''
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from starlette.datastructures import Headers
+from starlette.middleware import cors
+
+# Browsers cap it (Chrome at 2 hours, Firefox at 24 hours)
+CORS_MAX_AGE = 7200
+PREFLIGHT_CACHE_SIZE = 10_000
+
+
+def split_origin(origin: str) -> Optional[Tuple[str, str, str]]:
+    '''
+    "https://a.example.com:8443" -> ("https", "a.example.com", ":8443")
+    '''
+    scheme, sep, authority = origin.partition("://")
+    if not sep or not authority:
+        return None
+    host, colon, port = authority.rpartition(":")
+    # No port, or the ":" is part of an IPv6 address ("[::1]")
+    if not colon or not port.isdigit():
+        return scheme, authority, ""
+    return scheme, host, colon + port
+
+
+class _Node:
+    __slots__ = ("children", "wildcard")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        # (scheme, port) of the "*." patterns that end here
+        self.wildcard: Set[Tuple[str, str]] = set()
+
+
+class OriginMatcher:
+    def __init__(self, origins: Iterable[str]):
+        self.exact: Set[str] = set()
+        self.root = _Node()
+        for origin in origins:
+            parts = split_origin(origin)
+            if parts is None or not parts[1].startswith("*."):
+                self.exact.add(origin)
+                continue
+            scheme, host, port = parts
+            node = self.root
+            for label in reversed(host[2:].split(".")):
+                node = node.children.setdefault(label, _Node())
+            node.wildcard.add((scheme, port))
+
+    def __contains__(self, origin: str) -> bool:
+        if origin in self.exact:
+            return True
+        if not self.root.children:
+            return False
+        parts = split_origin(origin)
+        if parts is None:
+            return False
+        scheme, host, port = parts
+        labels = host.split(".")
+        if "" in labels:
+            return False
+        node = self.root
+        # The first label is the one that matches the "*"
+        for label in reversed(labels[1:]):
+            node = node.children.get(label)
+            if node is None:
+                return False
+            if (scheme, port) in node.wildcard:
+                return True
+        return False
+
+
+class CORSMiddleware(cors.CORSMiddleware):
+    def __init__(self, app, allow_origins: Iterable[str] = (),
+                 max_age: int = CORS_MAX_AGE,
+                 preflight_cache_size: int = PREFLIGHT_CACHE_SIZE,
+                 **kwargs):
+        allow_origins = list(allow_origins)
+        super().__init__(app, allow_origins=allow_origins, max_age=max_age,
+                         **kwargs)
+        self.origin_matcher = OriginMatcher(allow_origins)
+        self.preflight_cache_size = preflight_cache_size
+        # (origin, method, headers, private network) -> (status, headers,
+        # body) of the preflight response
+        self._preflights: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.allow_all_origins:
+            return True
+        if self.allow_origin_regex is not None and \
+                self.allow_origin_regex.fullmatch(origin):
+            return True
+        return origin in self.origin_matcher
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "OPTIONS":
+            await super().__call__(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        origin = headers.get("origin")
+        method = headers.get("access-control-request-method")
+        if origin is None or method is None:
+            await super().__call__(scope, receive, send)
+            return
+        key = (origin, method,
+               headers.get("access-control-request-headers"),
+               headers.get("access-control-request-private-network"))
+        cached = self._preflights.get(key)
+        if cached is None:
+            response = self.preflight_response(request_headers=headers)
+            cached = (response.status_code, tuple(response.raw_headers),
+                      response.body)
+            self._preflights[key] = cached
+            if len(self._preflights) > self.preflight_cache_size:
+                self._preflights.popitem(last=False)
+        else:
+            self._preflights.move_to_end(key)
+        status_code, raw_headers, body = cached
+        # A new list each time, the middleware before this one can change it
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": list(raw_headers)})
+        await send({"type": "http.response.body", "body": body})